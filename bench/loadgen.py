@@ -0,0 +1,198 @@
+# Copyright (C) 2026 Oleh Mamont
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org>.
+
+# Drives /v1/images/generations with a fixed number of concurrent
+# clients and reports throughput, latency percentiles, the proxy's
+# peak RSS and its event loop lag.
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import httpx
+
+from pathlib import Path
+from typing import Dict
+
+# ============================================================
+# Proxy-side measurements
+# ============================================================
+
+def peak_rss(pid: int | None) -> int | None:
+    # VmHWM is the process's resident set high-water mark
+    if not pid:
+        return None
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    return samples
+
+
+def histogram_quantile(samples: Dict[str, float], name: str, q: float) -> float | None:
+    # upper bound of the bucket holding the q-th observation
+    buckets = []
+    for key, count in samples.items():
+        if key.startswith(f'{name}_bucket{{le="'):
+            bound = key[len(name) + 12:-2]
+            buckets.append((float("inf") if bound == "+Inf" else float(bound), count))
+    buckets.sort()
+    if not buckets or not buckets[-1][1]:
+        return None
+    target = q * buckets[-1][1]
+    for bound, count in buckets:
+        if count >= target:
+            return bound
+    return None
+
+
+async def loop_lag(http: httpx.AsyncClient, url: str) -> dict:
+    try:
+        r = await http.get(f"{url}/metrics")
+        r.raise_for_status()
+    except httpx.HTTPError:
+        return {}
+    samples = parse_metrics(r.text)
+    worst = samples.get("poligen_event_loop_lag_max_seconds")
+    return {
+        "p50": histogram_quantile(samples, "poligen_event_loop_lag_seconds", 0.50),
+        "p99": histogram_quantile(samples, "poligen_event_loop_lag_seconds", 0.99),
+        "max": round(worst, 4) if worst is not None else None,
+    }
+
+
+# ============================================================
+# Load
+# ============================================================
+
+def percentile(values: list, q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+
+async def run_load(args) -> dict:
+    latencies = []
+    statuses: Dict[str, int] = {}
+    body_bytes = 0
+    deadline = time.monotonic() + args.duration
+    remaining = args.requests
+
+    async def worker(http: httpx.AsyncClient, index: int):
+        nonlocal body_bytes, remaining
+        while time.monotonic() < deadline and (remaining is None or remaining > 0):
+            if remaining is not None:
+                remaining -= 1
+            payload = {
+                "prompt": f"bench {index} {random.random()}",
+                "n": args.n,
+                "size": args.size,
+                "response_format": args.response_format,
+            }
+            if args.output_format:
+                payload["output_format"] = args.output_format
+            if args.seeds:
+                # a small seed pool makes hits and coalescing measurable
+                payload["prompt"] = "bench"
+                payload["seed"] = random.randrange(args.seeds)
+            started = time.perf_counter()
+            try:
+                r = await http.post(f"{args.url}/v1/images/generations", json=payload)
+                status = str(r.status_code)
+                body_bytes += len(r.content)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(http, i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        lag = await loop_lag(http, args.url)
+
+    ok = statuses.get("200", 0)
+    return {
+        "timestamp": int(time.time()),
+        "name": args.name,
+        "config": {
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+            "n": args.n,
+            "size": args.size,
+            "response_format": args.response_format,
+            "output_format": args.output_format,
+            "seeds": args.seeds,
+        },
+        "requests": len(latencies),
+        "ok": ok,
+        "statuses": statuses,
+        "elapsed": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "ok_rps": round(ok / elapsed, 2) if elapsed else None,
+        "response_bytes": body_bytes,
+        "latency": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": round(max(latencies), 4) if latencies else None,
+        },
+        "peak_rss": peak_rss(args.pid),
+        "loop_lag": lag,
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Load generator for the image proxies")
+    parser.add_argument("--url", default="http://127.0.0.1:9200", help="proxy base URL")
+    parser.add_argument("--name", default="run", help="scenario name stored in the results")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=None, help="stop after this many requests")
+    parser.add_argument("--duration", type=float, default=30.0, help="stop after this many seconds")
+    parser.add_argument("--n", type=int, default=1, help="images per request")
+    parser.add_argument("--size", default="1024x1024")
+    parser.add_argument("--response-format", default="b64_json", choices=["b64_json", "url"])
+    parser.add_argument("--output-format", default=None, choices=["png", "jpeg", "webp"])
+    parser.add_argument("--seeds", type=int, default=0, help="draw seeds from this many values, 0 = unseeded")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--pid", type=int, default=None, help="proxy process id, for peak RSS")
+    parser.add_argument("--out", default=None, help="write the JSON result here")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    result = asyncio.run(run_load(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
@@ -0,0 +1,169 @@
+# Copyright (C) 2026 Oleh Mamont
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org>.
+
+# Local stand-in for Pollinations, serves /image/{prompt} (paid API)
+# and /prompt/{prompt} (free API) with configurable latency, image
+# sizes, error and 429 rates, revoked keys and slow-drip bodies.
+
+import io
+import os
+import math
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# ============================================================
+# Behaviour
+# ============================================================
+
+JPEG_MAGIC = b"\xff\xd8\xff\xe0"
+MAX_IMAGE_BYTES = 16 * 1024 * 1024
+
+
+def parse_latency(spec: str):
+    """
+    "fixed:S", "uniform:A,B" or "lognormal:MEDIAN,SIGMA", in seconds
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"bad latency spec: {spec!r}")
+
+
+class Behaviour:
+    def __init__(self, args):
+        self.latency = parse_latency(args.latency)
+        self.bytes_per_pixel = args.bytes_per_pixel
+        self.image_bytes = args.image_bytes
+        self.error_rate = args.error_rate
+        self.rate_429 = args.rate_429
+        self.drip_rate = args.drip_rate
+        self.chunk = args.chunk
+        self.real_images = args.real_images
+        self.revoked = {f"Bearer {key}" for key in args.revoked_key or []}
+        self.rendered: dict = {}  # (width, height) -> JPEG bytes
+        # one random buffer, images are slices of it
+        self.body = JPEG_MAGIC + os.urandom(MAX_IMAGE_BYTES - len(JPEG_MAGIC))
+        self.served = 0
+        self.failed = 0
+        self.limited = 0
+        self.unauthorized = 0
+
+    def render(self, width: int, height: int) -> bytes:
+        # a decodable JPEG, for resizing and transcoding runs
+        key = (width, height)
+        if key not in self.rendered:
+            from PIL import Image
+
+            img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=90)
+            self.rendered[key] = out.getvalue()
+        return self.rendered[key]
+
+    def size_for(self, width: int, height: int) -> int:
+        if self.image_bytes:
+            size = self.image_bytes
+        else:
+            size = int(width * height * self.bytes_per_pixel)
+        return max(len(JPEG_MAGIC), min(size, MAX_IMAGE_BYTES))
+
+    async def drip(self, body: memoryview):
+        delay = self.chunk / self.drip_rate
+        for offset in range(0, len(body), self.chunk):
+            yield bytes(body[offset:offset + self.chunk])
+            await asyncio.sleep(delay)
+
+
+# ============================================================
+# App
+# ============================================================
+
+def make_app(behaviour: Behaviour) -> FastAPI:
+    app = FastAPI(title="Pollinations mock")
+
+    async def image(request: Request):
+        await asyncio.sleep(behaviour.latency())
+        if request.headers.get("authorization") in behaviour.revoked:
+            behaviour.unauthorized += 1
+            return JSONResponse({"error": "invalid key"}, status_code=401)
+        roll = random.random()
+        if roll < behaviour.rate_429:
+            behaviour.limited += 1
+            return JSONResponse({"error": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+        if roll < behaviour.rate_429 + behaviour.error_rate:
+            behaviour.failed += 1
+            return JSONResponse({"error": "mock failure"}, status_code=500)
+
+        width = int(request.query_params.get("width", 1024))
+        height = int(request.query_params.get("height", 1024))
+        if behaviour.real_images:
+            body = memoryview(behaviour.render(width, height))
+        else:
+            body = memoryview(behaviour.body)[:behaviour.size_for(width, height)]
+        behaviour.served += 1
+        if behaviour.drip_rate:
+            return StreamingResponse(behaviour.drip(body), media_type="image/jpeg")
+        return Response(bytes(body), media_type="image/jpeg")
+
+    app.add_api_route("/image/{prompt:path}", image, methods=["GET"])
+    app.add_api_route("/prompt/{prompt:path}", image, methods=["GET"])
+
+    @app.get("/health")
+    async def health():
+        return {
+            "served": behaviour.served,
+            "failed": behaviour.failed,
+            "limited": behaviour.limited,
+            "unauthorized": behaviour.unauthorized,
+        }
+
+    return app
+
+
+# ============================================================
+# Local run
+# ============================================================
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Mock Pollinations image upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="lognormal:0.3,0.5", help="fixed:S, uniform:A,B or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--bytes-per-pixel", type=float, default=0.2, help="image size relative to width*height")
+    parser.add_argument("--image-bytes", type=int, default=0, help="fixed image size, overrides --bytes-per-pixel")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--drip-rate", type=int, default=0, help="send bodies at this many bytes/s, 0 = all at once")
+    parser.add_argument("--real-images", action="store_true", help="serve decodable JPEGs of the requested size (needs Pillow)")
+    parser.add_argument("--revoked-key", action="append", help="answer 401 to this API key, repeatable")
+    parser.add_argument("--chunk", type=int, default=16 * 1024, help="drip chunk size")
+    return parser
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = build_parser().parse_args()
+    uvicorn.run(make_app(Behaviour(args)), host=args.host, port=args.port, log_level="warning")
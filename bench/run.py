@@ -0,0 +1,168 @@
+# Copyright (C) 2026 Oleh Mamont
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org>.
+
+# Runs the standard scenarios: for each one a fresh mock upstream and a
+# fresh proxy, then the load generator. All results go into one JSON
+# file so runs can be diffed against each other.
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import httpx
+
+from pathlib import Path
+
+import loadgen
+
+BENCH = Path(__file__).resolve().parent
+
+# mock: mock_upstream.py flags, load: loadgen.py flags, proxy: serve_proxy.py flags
+SCENARIOS = {
+    "baseline": {
+        "mock": ["--latency", "lognormal:0.3,0.5"],
+        "load": ["--concurrency", "16"],
+    },
+    "fanout": {
+        "mock": ["--latency", "lognormal:0.3,0.5"],
+        "load": ["--concurrency", "8", "--n", "4"],
+    },
+    "large": {
+        "mock": ["--latency", "fixed:0.2", "--image-bytes", str(8 * 1024 * 1024)],
+        "load": ["--concurrency", "8", "--size", "2560x1440"],
+    },
+    "url": {
+        "mock": ["--latency", "fixed:0.2", "--image-bytes", str(4 * 1024 * 1024)],
+        "load": ["--concurrency", "8", "--response-format", "url"],
+    },
+    "thumbnails": {
+        "mock": ["--latency", "fixed:0.2", "--real-images"],
+        "load": ["--concurrency", "8", "--size", "256x256", "--output-format", "webp"],
+    },
+    "seeded": {
+        "mock": ["--latency", "lognormal:0.3,0.5"],
+        "load": ["--concurrency", "16", "--seeds", "32"],
+    },
+    "slow-drip": {
+        "mock": ["--latency", "fixed:0.1", "--image-bytes", str(1024 * 1024), "--drip-rate", str(512 * 1024)],
+        "load": ["--concurrency", "16"],
+    },
+    "tail": {
+        "mock": ["--latency", "lognormal:0.3,1.2"],
+        "load": ["--concurrency", "16"],
+    },
+    "tail-hedged": {
+        "mock": ["--latency", "lognormal:0.3,1.2"],
+        "load": ["--concurrency", "16"],
+        "proxy": ["--hedge", "0.2"],
+    },
+    "flaky": {
+        "mock": ["--latency", "lognormal:0.3,0.5", "--error-rate", "0.05", "--rate-429", "0.05"],
+        "load": ["--concurrency", "16"],
+    },
+}
+
+
+def spawn(*args: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], stdout=subprocess.DEVNULL)
+
+
+def stop(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url}: process exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url}: not ready after {timeout}s")
+
+
+def run_scenario(proxy: str, name: str, scenario: dict, args) -> dict:
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    with tempfile.TemporaryDirectory(prefix="poligen-bench-") as state:
+        mock = spawn(str(BENCH / "mock_upstream.py"), "--port", str(args.mock_port), *scenario["mock"])
+        served = None
+        try:
+            wait_ready(f"{mock_url}/health", mock)
+            server = spawn(
+                str(BENCH / "serve_proxy.py"), proxy,
+                "--upstream", mock_url,
+                "--port", str(args.proxy_port),
+                "--state", state,
+                *scenario.get("proxy", []),
+            )
+            try:
+                wait_ready(f"{proxy_url}/stats", server)
+                load = loadgen.build_parser().parse_args([
+                    "--url", proxy_url,
+                    "--name", f"{proxy}/{name}",
+                    "--duration", str(args.duration),
+                    "--pid", str(server.pid),
+                    *scenario["load"],
+                ])
+                result = asyncio.run(loadgen.run_load(load))
+            finally:
+                stop(server)
+            served = httpx.get(f"{mock_url}/health").json()
+        finally:
+            stop(mock)
+    result["mock"] = {"args": scenario["mock"], **(served or {})}
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the proxy benchmark scenarios")
+    parser.add_argument("--proxy", choices=["paid", "free", "both"], default="both")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load per scenario")
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--proxy-port", type=int, default=9200)
+    parser.add_argument("--out", default=None, help="default: bench/results/<timestamp>.json")
+    args = parser.parse_args()
+
+    proxies = ["paid", "free"] if args.proxy == "both" else [args.proxy]
+    results = []
+    for proxy in proxies:
+        for name in args.scenario or SCENARIOS:
+            result = run_scenario(proxy, name, SCENARIOS[name], args)
+            latency = result["latency"]
+            print(
+                f"[bench] {proxy}/{name}: {result['rps']} req/s, ok {result['ok']}/{result['requests']}, "
+                f"p50 {latency['p50']}s p95 {latency['p95']}s p99 {latency['p99']}s, "
+                f"peak RSS {(result['peak_rss'] or 0) // (1024 * 1024)} MiB, "
+                f"loop lag max {result['loop_lag'].get('max')}s"
+            )
+            results.append(result)
+
+    out = Path(args.out or BENCH / "results" / f"{int(time.time())}.json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+    print(f"[bench] results written to {out}")
@@ -0,0 +1,98 @@
+# Copyright (C) 2026 Oleh Mamont
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org>.
+
+# Runs one of the proxies against the mock upstream with its cache,
+# files, batches and limiter state moved into a scratch directory, so a bench
+# run never touches the real /root/ai state or the real API key.
+
+import sys
+import argparse
+import importlib.util
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+PROXIES = {
+    "paid": REPO / "root/ai/polligenapi4261/polligen.py",
+    "free": REPO / "root/ai/polligenapi4290-free/polligen-free.py",
+}
+
+
+def load_proxy(name: str):
+    spec = importlib.util.spec_from_file_location(f"poligen_{name}", PROXIES[name])
+    module = importlib.util.module_from_spec(spec)
+    # registered, so worker processes can unpickle functions from it
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def isolate(module, state: Path, limits: bool, cache: bool, hedge: float | None, keys: str | None = None):
+    if module.cache is not None:
+        module.cache.root = state / "cache"
+        if not cache:
+            module.cache = None
+    module.files.root = state / "files"
+    module.files.secret_path = state / "files.secret"
+    if hasattr(module, "batches"):
+        module.batches.root = state / "batches"
+    module.ADAPTIVE_STATE_PATH = str(state / "adaptive.json")
+    module.SPILL_DIR = str(state / "spill")
+    if hedge is not None:
+        # the real minimum delay is far above mock latencies
+        module.HEDGE_MIN_DELAY = hedge
+        module.HEDGE_ENABLED = True
+
+    if not hasattr(module, "router"):
+        module.client.cache = module.cache
+        # the mock wants no key, do not send the real one anywhere
+        module.client.api_key = None
+        module.client.client.headers.pop("Authorization", None)
+        if hedge is not None:
+            module.client.hedge = module.HedgePolicy(module.HEDGE_PERCENTILE, module.HEDGE_BUDGET)
+        if not limits:
+            module.limiter.set_rpm(10**6)
+            module.client.on_response = None
+        return
+
+    # rebuilt with keys from a scratch file (none unless --keys), never the real key file
+    module.LIMITER_DB_PATH = str(state / Path(module.LIMITER_DB_PATH).name)
+    module.LIMITER_STATE_PATH = str(state / Path(module.LIMITER_STATE_PATH).name)
+    for conf in module.BACKENDS:
+        if conf.get("api_key_path"):
+            conf["api_key_path"] = keys or str(state / "pollinations.key")
+        if not limits:
+            conf["rpm"] = conf["tpd"] = None
+    module.router = module.Router(module.BACKENDS, module.cache, module.flights)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a proxy against the bench mock")
+    parser.add_argument("proxy", choices=sorted(PROXIES))
+    parser.add_argument("--upstream", default="http://127.0.0.1:9100")
+    parser.add_argument("--state", required=True, help="scratch directory for cache, files and limits")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--limits", action="store_true", help="keep the RPM/TPD limits and adaptive rates (per-key limits from --keys always apply)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the seeded image disk cache")
+    parser.add_argument("--keys", default=None, metavar="PATH", help="paid proxy key file, for trying the key pool")
+    parser.add_argument("--hedge", type=float, default=None, metavar="MIN_DELAY", help="enable hedging, never earlier than MIN_DELAY seconds")
+    args = parser.parse_args()
+
+    module = load_proxy(args.proxy)
+    isolate(module, Path(args.state), args.limits, not args.no_cache, args.hedge, args.keys)
+    module.use_upstream(args.upstream)
+    uvicorn.run(module.app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -14,53 +14,2342 @@
 # along with this program. If not, see <https://www.gnu.org>.
 
 
+import io
+import os
+import re
+import hmac
+import json
+import mmap
 import random
 import time
 import base64
+import bisect
 import asyncio
+import sqlite3
+import hashlib
+import secrets
+import shutil
+import tempfile
+import weakref
+import multiprocessing
 import httpx
 
 from pathlib import Path
-from typing import Dict, Tuple
-from urllib.parse import quote
-from contextlib import asynccontextmanager
-from collections import deque
-from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, Tuple
+from urllib.parse import quote, urlsplit
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.background import BackgroundTask
+from sse_starlette.sse import EventSourceResponse
+
+try:
+    import h2  # HTTP/2 support for httpx, pip install "httpx[http2]"
+except ImportError:
+    h2 = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+# ============================================================
+# API key loader (file-based, no env)
+# ============================================================
+
+def read_api_key(path: str) -> str | None:
+    try:
+        key = Path(path).read_text(encoding="utf-8").strip()
+        return key if key else None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[poligen] Failed to read API key file: {e}")
+        return None
+
+
+def read_api_keys(path: str) -> list:
+    """
+    One key per line, optionally with its own name and limits:
+
+        sk_first_key
+        sk_second_key  name=team-b  rpm=10  tpd=1000
+
+    Blank lines and lines starting with "#" are skipped.
+    """
+    try:
+        text = Path(path).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"[poligen] Failed to read API key file: {e}")
+        return []
+
+    keys = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, *options = line.split()
+        entry = {"key": key}
+        for option in options:
+            name, _, value = option.partition("=")
+            if name in ("rpm", "tpd") and value.isdigit():
+                entry[name] = int(value)
+            elif name == "name" and value:
+                entry["name"] = value
+            else:
+                print(f"[poligen] {path}:{number}: ignoring {option!r}")
+        keys.append(entry)
+    return keys
+
+
+def key_fingerprint(key: str) -> str:
+    # stable label for a key that has no name, never the key itself
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:8]
+
+
+# ============================================================
+# Rate/Limits tracking
+# ============================================================
+
+TPD_LIMIT = 450  # paid key limit per day (UTC day)
+RPM_LIMIT = 5    # paid key limit per minute, where the adaptive rate starts
+FREE_RPM_LIMIT = 12  # free endpoint, where its adaptive rate starts
+
+QUEUE_MAX = 20          # requests waiting for an RPM slot before refusing
+QUEUE_MAX_WAIT = 120.0  # seconds a request may wait for an RPM slot
+BACKGROUND_RESERVE = 1  # RPM tokens background (batch) work always leaves to interactive requests
+
+# "memory": per process, lost on restart
+# "file":   per process, saved to LIMITER_STATE_PATH
+# "sqlite": shared by all workers on this host and kept across restarts
+LIMITER_BACKEND = "sqlite"
+LIMITER_STATE_PATH = "/root/ai/polligenapi4261/limits-{name}.json"
+LIMITER_DB_PATH = "/root/ai/polligenapi4261/limits.sqlite"
+LIMITER_SAVE_INTERVAL = 5.0  # seconds between "file" backend saves
+
+ADAPTIVE_ENABLED = True  # learn each upstream's RPM from its answers, starting at the configured one
+ADAPTIVE_INCREASE = 1.0  # RPM gained per minute spent at the limit without refusals
+ADAPTIVE_DECREASE = 0.5  # RPM multiplier when upstream answers 429 or 503
+ADAPTIVE_DECREASE_INTERVAL = 10.0  # one decrease per burst of refusals
+ADAPTIVE_MIN_RPM = 1.0
+ADAPTIVE_MAX_FACTOR = 4.0  # never above the configured RPM times this
+ADAPTIVE_MAX_PAUSE = 86400.0  # longest Retry-After honoured, seconds
+ADAPTIVE_STATE_PATH = "/root/ai/polligenapi4261/adaptive.json"
+ADAPTIVE_SAVE_INTERVAL = 30.0
+
+DAY_SECONDS = 86400
+
+
+class AdmissionError(Exception):
+    def __init__(self, message: str, retry_after: float, status_code: int = 503):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+def utc_day(now: float) -> int:
+    return int(now // DAY_SECONDS)
+
+
+class MemoryLimiter:
+    # RPM token bucket (burst = RPM_LIMIT) + TPD counter reset at UTC midnight
+    def __init__(self, rpm: int, tpd: int):
+        self.capacity = float(rpm)
+        self.rate = rpm / 60.0  # tokens per second
+        self.tpd = tpd
+        self.max_units = rpm  # largest single request, the bucket may shrink below it
+
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.day = utc_day(self.updated)
+        self.daily_count = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _advance(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        day = utc_day(now)
+        if day != self.day:
+            self.day = day
+            self.daily_count = 0
+
+    def _changed(self):
+        pass
+
+    def _daily_error(self, now: float) -> AdmissionError:
+        return AdmissionError("Daily limit exceeded", (self.day + 1) * DAY_SECONDS - now)
+
+    def check_daily(self, units: int):
+        now = time.time()
+        self._advance(now)
+        if self.daily_count + units > self.tpd:
+            raise self._daily_error(now)
+
+    def acquire(self, units: int) -> float:
+        # 0.0 when taken, otherwise seconds until enough RPM tokens;
+        # a full bucket admits more than it holds and goes into debt
+        now = time.time()
+        self._advance(now)
+        if self.daily_count + units > self.tpd:
+            raise self._daily_error(now)
+        if self.tokens < min(units, self.capacity):
+            return (min(units, self.capacity) - self.tokens) / self.rate
+
+        self.tokens -= units
+        self.daily_count += units
+        self._changed()
+        return 0.0
+
+    def release(self, units: int):
+        # refund an admitted request that never went upstream
+        self._advance(time.time())
+        self.tokens = min(self.capacity, self.tokens + units)
+        self.daily_count = max(0, self.daily_count - units)
+        self._changed()
+
+    def wait_time(self, units: int) -> float:
+        self._advance(time.time())
+        return max(0.0, (min(units, self.capacity) - self.tokens) / self.rate)
+
+    def set_rpm(self, rpm: float):
+        # tokens above the new size are dropped on the next refill
+        self.capacity = float(rpm)
+        self.rate = rpm / 60.0
+
+    def pause(self, seconds: float):
+        # upstream asked for a break: empty the bucket that far into debt
+        self._advance(time.time())
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self._changed()
+
+    def state(self) -> dict:
+        self._advance(time.time())
+        return {
+            "tokens": round(self.tokens, 3),
+            "daily_count": self.daily_count,
+            "daily_reset": datetime.utcfromtimestamp((self.day + 1) * DAY_SECONDS).isoformat() + "Z",
+        }
+
+
+class FileLimiter(MemoryLimiter):
+    def __init__(self, rpm: int, tpd: int, path: str, interval: float):
+        super().__init__(rpm, tpd)
+        self.path = Path(path)
+        self.interval = interval
+        self.saved = 0.0
+
+    def open(self):
+        try:
+            state = json.loads(self.path.read_text(encoding="utf-8"))
+            self.tokens = min(self.capacity, float(state["tokens"]))
+            self.updated = float(state["updated"])
+            self.day = int(state["day"])
+            self.daily_count = int(state["daily_count"])
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[poligen] Failed to read limiter state: {e}")
+
+    def close(self):
+        self.save()
+
+    def _changed(self):
+        if self.updated - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        state = {
+            "tokens": self.tokens,
+            "updated": self.updated,
+            "day": self.day,
+            "daily_count": self.daily_count,
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(state), encoding="utf-8")
+            os.replace(tmp, self.path)
+            self.saved = self.updated
+        except OSError as e:
+            print(f"[poligen] Failed to save limiter state: {e}")
+
+
+class SqliteLimiter(MemoryLimiter):
+    # every check is one short IMMEDIATE transaction on the backend's row
+    def __init__(self, rpm: int, tpd: int, path: str, name: str):
+        super().__init__(rpm, tpd)
+        self.path = path
+        self.name = name
+        self.db: sqlite3.Connection | None = None
+
+    def open(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS limiters ("
+            "name TEXT PRIMARY KEY, "
+            "tokens REAL, updated REAL, day INTEGER, daily_count INTEGER)"
+        )
+        self.db.execute(
+            "INSERT OR IGNORE INTO limiters VALUES (?, ?, ?, ?, 0)",
+            (self.name, self.capacity, self.updated, self.day),
+        )
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @contextmanager
+    def _shared(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.tokens, self.updated, self.day, self.daily_count = self.db.execute(
+                "SELECT tokens, updated, day, daily_count FROM limiters WHERE name = ?",
+                (self.name,),
+            ).fetchone()
+            self.tokens = min(self.capacity, self.tokens)
+            yield
+            self.db.execute(
+                "UPDATE limiters SET tokens = ?, updated = ?, day = ?, daily_count = ? WHERE name = ?",
+                (self.tokens, self.updated, self.day, self.daily_count, self.name),
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def check_daily(self, units: int):
+        with self._shared():
+            super().check_daily(units)
+
+    def acquire(self, units: int) -> float:
+        with self._shared():
+            return super().acquire(units)
+
+    def release(self, units: int):
+        with self._shared():
+            super().release(units)
+
+    def wait_time(self, units: int) -> float:
+        with self._shared():
+            return super().wait_time(units)
+
+    def pause(self, seconds: float):
+        with self._shared():
+            super().pause(seconds)
+
+    def state(self) -> dict:
+        with self._shared():
+            return super().state()
+
+
+def make_limiter(name: str, rpm: int, tpd: int) -> MemoryLimiter:
+    if LIMITER_BACKEND == "sqlite":
+        return SqliteLimiter(rpm, tpd, LIMITER_DB_PATH, name)
+    if LIMITER_BACKEND == "file":
+        path = LIMITER_STATE_PATH.format(name=name)
+        return FileLimiter(rpm, tpd, path, LIMITER_SAVE_INTERVAL)
+    return MemoryLimiter(rpm, tpd)
+
+
+def retry_after_seconds(response: httpx.Response) -> float | None:
+    # Retry-After as seconds or as an HTTP date
+    value = response.headers.get("retry-after", "").strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limit_pause(response: httpx.Response) -> float | None:
+    # seconds upstream wants us to stay away: Retry-After on a refusal,
+    # or RateLimit-Remaining: 0 with its reset (seconds or epoch)
+    if response.status_code in (429, 503):
+        seconds = retry_after_seconds(response)
+        if seconds is not None:
+            return min(seconds, ADAPTIVE_MAX_PAUSE)
+    headers = response.headers
+    remaining = headers.get("ratelimit-remaining", headers.get("x-ratelimit-remaining"))
+    reset = headers.get("ratelimit-reset", headers.get("x-ratelimit-reset"))
+    try:
+        if remaining is None or reset is None or float(remaining) > 0:
+            return None
+        seconds = float(reset)
+    except ValueError:
+        return None
+    if seconds > 10**9:
+        seconds -= time.time()
+    return min(max(0.0, seconds), ADAPTIVE_MAX_PAUSE)
+
+
+class AdaptiveRate:
+    # AIMD on a limiter's RPM: up while upstream accepts requests at the
+    # limit, cut when it answers 429/503, paused for as long as it asks
+    def __init__(self, limiter: MemoryLimiter, rpm: float, saturated: Callable[[], bool]):
+        self.limiter = limiter
+        self.saturated = saturated
+        self.seed = float(rpm)
+        self.rpm = float(rpm)
+        self.decreased_at = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.pauses = 0
+        self.dirty = False  # learned rate not saved yet
+
+    def set_rpm(self, rpm: float):
+        self.rpm = min(self.seed * ADAPTIVE_MAX_FACTOR, max(ADAPTIVE_MIN_RPM, rpm))
+        self.limiter.set_rpm(self.rpm)
+        self.dirty = True
+
+    def observe(self, response: httpx.Response):
+        pause = rate_limit_pause(response)
+        if response.status_code in (429, 503):
+            now = time.monotonic()
+            if now - self.decreased_at >= ADAPTIVE_DECREASE_INTERVAL:
+                self.decreased_at = now
+                self.decreases += 1
+                self.set_rpm(self.rpm * ADAPTIVE_DECREASE)
+        elif not response.is_error and self.saturated():
+            # one success per token, so about ADAPTIVE_INCREASE per minute at the limit
+            self.increases += 1
+            self.set_rpm(self.rpm + ADAPTIVE_INCREASE / self.rpm)
+        if pause:
+            self.pauses += 1
+            self.limiter.pause(pause)
+
+    def stats(self) -> dict:
+        return {
+            "rpm": round(self.rpm, 2),
+            "seed_rpm": self.seed,
+            "max_rpm": self.seed * ADAPTIVE_MAX_FACTOR,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "pauses": self.pauses,
+        }
+
+
+def load_rates(path: str, rates: Dict[str, AdaptiveRate]):
+    # learned rates from the last run, by backend name
+    try:
+        saved = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"[poligen] Failed to read adaptive rates: {e}")
+        return
+    for name, rate in rates.items():
+        if name in saved and saved[name].get("seed_rpm") == rate.seed:
+            rate.set_rpm(float(saved[name]["rpm"]))
+            rate.dirty = False
+
+
+def save_rates(path: str, rates: Dict[str, AdaptiveRate]):
+    try:
+        saved = json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        saved = {}
+    for name, rate in rates.items():
+        saved[name] = {"rpm": rate.rpm, "seed_rpm": rate.seed, "updated": int(time.time())}
+        rate.dirty = False
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(f"{path}.tmp")
+    tmp.write_text(json.dumps(saved, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class AdmissionScheduler:
+    # fair queue in front of the limiter: per-user FIFOs served round-robin
+    def __init__(self, limiter: MemoryLimiter, max_queue: int, max_wait: float):
+        self.limiter = limiter
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()  # user -> [units, future]
+        self.queued = 0
+        self.background: deque = deque()  # [units, future], served only when queues are empty
+        self.timer: asyncio.TimerHandle | None = None
+
+        self.admitted = 0
+        self.admitted_background = 0
+        self.delayed = 0
+        self.rejected_daily = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    def estimate_wait(self, units: int) -> float:
+        waiting = sum(w[0] for q in self.queues.values() for w in q)
+        return self.limiter.wait_time(waiting + units)
+
+    async def acquire(self, user: str, units: int, max_wait: float | None = None):
+        if units > self.limiter.max_units:
+            raise AdmissionError(
+                f"n={units} exceeds rate limit of {self.limiter.max_units} per minute",
+                60.0,
+                status_code=400,
+            )
+
+        try:
+            if not self.queued:
+                if self.limiter.acquire(units) == 0.0:
+                    self.admitted += 1
+                    return
+            else:
+                self.limiter.check_daily(units)
+        except AdmissionError:
+            self.rejected_daily += 1
+            raise
+
+        if self.queued >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionError("Rate limit queue is full", self.estimate_wait(units))
+
+        waiter = [units, asyncio.get_running_loop().create_future()]
+        self.queues.setdefault(user, deque()).append(waiter)
+        self.queued += 1
+        self.delayed += 1
+        self._dispatch()
+
+        timeout = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            self._remove(user, waiter)
+            self.rejected_timeout += 1
+            raise AdmissionError("Rate limit wait exceeded", self.estimate_wait(units))
+        except AdmissionError:
+            self.rejected_daily += 1
+            raise
+        except asyncio.CancelledError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release(units)  # granted just before the caller went away
+            else:
+                self._remove(user, waiter)
+            raise
+
+        self.admitted += 1
+
+    async def acquire_background(self, units: int):
+        # batch work: no queue limit, no deadline, never ahead of a waiting request
+        if units > self.limiter.max_units:
+            raise AdmissionError(
+                f"n={units} exceeds rate limit of {self.limiter.max_units} per minute",
+                60.0,
+                status_code=400,
+            )
+        try:
+            self.limiter.check_daily(units)
+        except AdmissionError:
+            self.rejected_daily += 1
+            raise
+
+        waiter = [units, asyncio.get_running_loop().create_future()]
+        self.background.append(waiter)
+        self._dispatch()
+        try:
+            await waiter[1]
+        except AdmissionError:
+            self.rejected_daily += 1
+            raise
+        except asyncio.CancelledError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release(units)
+            elif waiter in self.background:
+                self.background.remove(waiter)
+            raise
+        self.admitted_background += 1
+
+    def release(self, units: int):
+        self.limiter.release(units)
+        self._dispatch()
+
+    def _remove(self, user: str, waiter: list):
+        queue = self.queues.get(user)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self.queues[user]
+        self._dispatch()
+
+    def _dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        while self.queues:
+            user, queue = next(iter(self.queues.items()))
+            units, fut = queue[0]
+            if not fut.done():  # skip timed out / cancelled waiters
+                try:
+                    wait = self.limiter.acquire(units)
+                except AdmissionError as e:
+                    fut.set_exception(e)
+                    wait = 0.0
+                if wait > 0.0:
+                    # strict round-robin: wait for enough tokens for this head
+                    loop = asyncio.get_running_loop()
+                    self.timer = loop.call_later(wait, self._dispatch)
+                    return
+                if not fut.done():
+                    fut.set_result(None)
+
+            queue.popleft()
+            self.queued -= 1
+
+            # next user's turn
+            del self.queues[user]
+            if queue:
+                self.queues[user] = queue
+
+        while self.background:
+            units, fut = self.background[0]
+            if not fut.done():
+                # the last tokens of the bucket stay free for the next interactive request
+                reserve = min(BACKGROUND_RESERVE, max(0, int(self.limiter.capacity) - units))
+                try:
+                    wait = self.limiter.wait_time(units + reserve)
+                    if wait == 0.0:
+                        wait = self.limiter.acquire(units)
+                except AdmissionError as e:
+                    fut.set_exception(e)
+                    wait = 0.0
+                if wait > 0.0:
+                    loop = asyncio.get_running_loop()
+                    self.timer = loop.call_later(wait, self._dispatch)
+                    return
+                if not fut.done():
+                    fut.set_result(None)
+            self.background.popleft()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "queued_users": len(self.queues),
+            "queued_background": len(self.background),
+            "admitted": self.admitted,
+            "admitted_background": self.admitted_background,
+            "delayed": self.delayed,
+            "rejected_daily": self.rejected_daily,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+def request_user(request: Request, body: dict) -> str:
+    # fairness bucket: OpenAI "user" field, then caller API key, then address
+    user = body.get("user")
+    if user:
+        return f"user:{user}"
+    auth = request.headers.get("authorization")
+    if auth:
+        return "key:" + hashlib.sha256(auth.encode("utf-8")).hexdigest()[:16]
+    return f"addr:{request.client.host if request.client else '-'}"
+
+
+def request_max_wait(request: Request) -> float | None:
+    try:
+        return float(request.headers["x-queue-timeout"])
+    except (KeyError, ValueError):
+        return None
+
+
+def retry_after_header(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, int(seconds + 0.999)))}
+
+
+# ============================================================
+# Image cache (content-addressed, seed-deterministic requests)
+# ============================================================
+
+CACHE_ENABLED = True
+CACHE_DIR = "/root/ai/polligenapi4261/cache"
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+
+
+class ImageCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size, LRU first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(
+        prompt: str,
+        width: int,
+        height: int,
+        model: str,
+        enhance: bool,
+        seed: int,
+    ) -> str:
+        raw = json.dumps(
+            [prompt, width, height, model, bool(enhance), int(seed)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def load(self):
+        # rebuild LRU index from disk, oldest mtime first
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        for path in self.root.glob("*/*"):
+            if path.suffix == ".tmp":
+                path.unlink(missing_ok=True)  # leftover of an interrupted write
+                continue
+            st = path.stat()
+            found.append((st.st_mtime, path.name, st.st_size))
+
+        found.sort()
+        self.entries.clear()
+        self.total_bytes = 0
+        for _, key, size in found:
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _read(self, key: str) -> "bytes | SpilledImage":
+        path = self.path_for(key)
+        f = open(path, "rb")
+        os.utime(path)  # keep LRU order across restarts
+        size = os.fstat(f.fileno()).st_size
+        if size > SPILL_THRESHOLD:
+            # served from the entry itself, the open file outlives an eviction
+            return SpilledImage(f, size)
+        with f:
+            return f.read()
+
+    def _write(self, key: str, data: "bytes | SpilledImage"):
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_buffer(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def _forget(self, key: str):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            self.path_for(key).unlink(missing_ok=True)
+
+    async def get(self, key: str, record: bool = True) -> "bytes | SpilledImage | None":
+        data = None
+        if key in self.entries:
+            try:
+                data = await asyncio.to_thread(self._read, key)
+            except FileNotFoundError:
+                self._forget(key)
+
+        if data is not None and key in self.entries:
+            self.entries.move_to_end(key)
+
+        if record:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.hit_bytes += len(data)
+        return data
+
+    async def put(self, key: str, data: "bytes | SpilledImage"):
+        if len(data) > self.max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError as e:
+            print(f"[poligen] Cache write failed: {e}")
+            return
+
+        self._forget(key)
+        self.entries[key] = len(data)
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            await asyncio.to_thread(self._evict)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "hit_bytes": self.hit_bytes,
+            "evictions": self.evictions,
+        }
+
+
+# ============================================================
+# Metrics (Prometheus text format)
+# ============================================================
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag probes
+METRICS_MAX_MODELS = 20  # distinct model label values before "other"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name: str, labels: tuple, key: tuple, value: float) -> str:
+    if value == int(value):
+        value = int(value)
+    if not labels:
+        return f"{name} {value}"
+    pairs = ",".join(f'{label}="{escape_label(str(v))}"' for label, v in zip(labels, key))
+    return f"{name}{{{pairs}}} {value}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}  # label values -> value
+
+    def inc(self, amount: float = 1.0, key: tuple = ()):
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, value: float, key: tuple = ()):
+        # mirror a value kept elsewhere, updated at scrape time
+        self.values[key] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(format_sample(self.name, self.labels, key, value))
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, key: tuple = ()):
+        self.values[key] = self.values.get(key, 0.0) - amount
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.values: Dict[tuple, list] = {}  # label values -> [bucket counts, sum]
+
+    def observe(self, value: float, key: tuple = ()):
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        labels = self.labels + ("le",)
+        for key, (counts, total) in self.values.items():
+            running = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                lines.append(format_sample(f"{self.name}_bucket", labels, key + (bound,), running))
+            lines.append(format_sample(f"{self.name}_sum", self.labels, key, round(total, 6)))
+            lines.append(format_sample(f"{self.name}_count", self.labels, key, running))
+        return lines
+
+
+# phase keys are built once, observing one allocates nothing
+PHASE_QUEUE_WAIT = ("queue_wait",)
+PHASE_CONNECT = ("connect",)
+PHASE_TTFB = ("ttfb",)
+PHASE_DOWNLOAD = ("download",)
+PHASE_ENCODE = ("encode",)
+PHASE_RESIZE = ("resize",)
+
+REQUESTS = Counter("poligen_requests_total", "Image generation requests.", ("status", "model"))
+REQUEST_SECONDS = Histogram("poligen_request_duration_seconds", "Image generation handler latency.", ("model",))
+PHASE_SECONDS = Histogram("poligen_phase_duration_seconds", "Per-image latency by phase.", ("phase",))
+UPSTREAM_BYTES = Counter("poligen_upstream_bytes_total", "Image bytes downloaded from upstream.")
+RESPONSE_BYTES = Counter("poligen_response_bytes_total", "Image response body bytes sent to clients.")
+IN_FLIGHT = Gauge("poligen_requests_in_flight", "Image generation requests being handled.")
+UPSTREAM_IN_FLIGHT = Gauge("poligen_upstream_in_flight", "Upstream generations running.")
+SLOT_WAITING = Gauge("poligen_slot_queue_depth", "Images waiting for a concurrency slot.")
+LOOP_LAG = Histogram("poligen_event_loop_lag_seconds", "Event loop scheduling delay.", buckets=LOOP_LAG_BUCKETS)
+LOOP_LAG_MAX = Gauge("poligen_event_loop_lag_max_seconds", "Largest event loop delay seen since start.")
+CANCELLED = Counter("poligen_cancelled_total", "Requests cancelled because the caller left.", ("reason",))
+MEMORY_USED = Gauge("poligen_memory_budget_used_bytes", "Image bytes reserved by in-flight requests.")
+MEMORY_WAITING = Gauge("poligen_memory_budget_waiting", "Requests waiting for memory budget.")
+SPILLED_BYTES = Counter("poligen_spilled_bytes_total", "Image bytes spilled to temp files.")
+
+# mirrored from the proxy's own counters at scrape time
+CACHE_HITS = Counter("poligen_cache_hits_total", "Seeded images served from the disk cache.")
+CACHE_MISSES = Counter("poligen_cache_misses_total", "Seeded images not found in the disk cache.")
+CACHE_BYTES = Gauge("poligen_cache_bytes", "Bytes stored in the disk cache.")
+COALESCED = Counter("poligen_coalesced_total", "Generations shared with an identical in-flight one.")
+RPM_TOKENS = Gauge("poligen_rpm_tokens", "RPM tokens left in the bucket.", ("backend",))
+DAILY_COUNT = Gauge("poligen_daily_count", "Units used in the current UTC day.", ("backend",))
+DAILY_LIMIT = Gauge("poligen_daily_limit", "Units allowed per UTC day.", ("backend",))
+ADMISSION_QUEUE = Gauge("poligen_admission_queue_depth", "Requests waiting for RPM tokens.", ("backend",))
+REJECTIONS = Counter("poligen_admission_rejections_total", "Requests refused by admission.", ("backend", "reason"))
+BACKEND_LATENCY = Gauge("poligen_backend_latency_ewma_seconds", "EWMA upstream latency.", ("backend",))
+BREAKER_STATE = Gauge("poligen_breaker_state", "Circuit breaker: 0 closed, 1 half-open, 2 open.", ("backend",))
+ADAPTIVE_RPM = Gauge("poligen_adaptive_rpm", "Learned upstream requests per minute.", ("backend",))
+POOL_CONNECTIONS = Gauge("poligen_upstream_connections", "Pooled upstream connections.", ("backend", "state"))
+POOL_CONNECTS = Counter("poligen_upstream_connects_total", "Upstream connections opened by requests.", ("backend",))
+POOL_REQUESTS = Counter("poligen_upstream_requests_total", "Upstream image requests sent.", ("backend",))
+BACKEND_ERRORS = Gauge("poligen_backend_error_rate", "EWMA upstream error rate.", ("backend",))
+
+METRICS = [
+    REQUESTS, REQUEST_SECONDS, PHASE_SECONDS, UPSTREAM_BYTES, RESPONSE_BYTES,
+    IN_FLIGHT, UPSTREAM_IN_FLIGHT, SLOT_WAITING, LOOP_LAG, LOOP_LAG_MAX, CANCELLED,
+    MEMORY_USED, MEMORY_WAITING, SPILLED_BYTES,
+    CACHE_HITS, CACHE_MISSES, CACHE_BYTES, COALESCED,
+    RPM_TOKENS, DAILY_COUNT, DAILY_LIMIT, ADMISSION_QUEUE, REJECTIONS,
+    BACKEND_LATENCY, BACKEND_ERRORS, BREAKER_STATE, POOL_CONNECTIONS, POOL_CONNECTS, POOL_REQUESTS,
+    ADAPTIVE_RPM,
+]
+
+metric_models: set = set()
+
+
+def model_label(model) -> str:
+    # bounded label set, clients choose the model string
+    model = str(model)
+    if model in metric_models:
+        return model
+    if len(metric_models) < METRICS_MAX_MODELS:
+        metric_models.add(model)
+        return model
+    return "other"
+
+
+async def watch_loop_lag():
+    # a sleep that wakes late means something blocked the loop
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(lag)
+        if lag > LOOP_LAG_MAX.values.get((), 0.0):
+            LOOP_LAG_MAX.set(lag)
+
+
+# ============================================================
+# Image files (response_format="url")
+# ============================================================
+
+FILES_DIR = "/root/ai/polligenapi4261/files"
+FILES_TTL = 3600  # seconds a returned image URL stays valid
+FILES_SECRET_PATH = "/root/ai/polligenapi4261/files.secret"  # URL signing key, created on first start
+PUBLIC_BASE_URL = None  # e.g. "https://img.example.com", None = taken from the request
+
+IMAGE_TYPES = {
+    b"\x89PNG": ("png", "image/png"),
+    b"\xff\xd8\xff": ("jpg", "image/jpeg"),
+    b"RIFF": ("webp", "image/webp"),
+    b"GIF8": ("gif", "image/gif"),
+}
+MEDIA_TYPES = {ext: media_type for ext, media_type in IMAGE_TYPES.values()}
+FILE_ID_RE = re.compile(r"[A-Za-z0-9_-]{8,64}\.(png|jpg|webp|gif)")
+
+
+def sniff_image(data: bytes) -> Tuple[str, str]:
+    for magic, kind in IMAGE_TYPES.items():
+        if data.startswith(magic):
+            return kind
+    return "jpg", "image/jpeg"
+
+
+class ImageStore:
+    def __init__(self, root: str, ttl: int, secret_path: str):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.secret_path = Path(secret_path)
+        self.secret = b""
+        self.stored = 0
+        self.expired = 0
+
+    def open(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        try:
+            self.secret = bytes.fromhex(self.secret_path.read_text(encoding="utf-8").strip())
+        except (FileNotFoundError, ValueError):
+            # shared by all workers, so it lives in a file rather than in memory
+            self.secret = os.urandom(32)
+            fd = os.open(self.secret_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.secret.hex())
+
+    def sign(self, file_id: str, expires: int) -> str:
+        msg = f"{file_id}:{expires}".encode("utf-8")
+        return hmac.new(self.secret, msg, hashlib.sha256).hexdigest()[:32]
+
+    def _link(self, img: "SpilledImage") -> str | None:
+        # a spilled body is already on disk, a hard link saves copying it
+        ext, _ = sniff_image(bytes(img.buffer()[:16]))
+        file_id = f"{secrets.token_urlsafe(16)}.{ext}"
+        try:
+            os.link(img.path, self.root / file_id)
+            os.utime(self.root / file_id)  # the URL lifetime starts now
+        except OSError:
+            return None
+        return file_id
+
+    async def publish(self, img: "ImageSource", base_url: str) -> str:
+        # written chunk by chunk, so upstream bodies never sit in memory whole
+        file_id = self._link(img) if isinstance(img, SpilledImage) else None
+        if file_id is None:
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in image_chunks(img):
+                        if file_id is None:
+                            ext, _ = sniff_image(bytes(chunk[:16]))
+                            file_id = f"{secrets.token_urlsafe(16)}.{ext}"
+                        f.write(chunk)
+                if file_id is None:
+                    raise ValueError("empty image")
+                os.replace(tmp, self.root / file_id)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+            finally:
+                if isinstance(img, httpx.Response):
+                    await img.aclose()
+        self.stored += 1
+
+        expires = int(time.time()) + self.ttl
+        sig = self.sign(file_id, expires)
+        return f"{base_url}/v1/images/files/{file_id}?expires={expires}&sig={sig}"
+
+    def resolve(self, file_id: str, expires: int, sig: str) -> Tuple[int, Path | None]:
+        # (http status, path)
+        if not FILE_ID_RE.fullmatch(file_id):
+            return 404, None
+        if not hmac.compare_digest(self.sign(file_id, expires), sig):
+            return 403, None
+        if expires < time.time():
+            return 410, None
+        path = self.root / file_id
+        if not path.is_file():
+            return 404, None
+        return 200, path
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for path in self.root.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+                    self.expired += 1
+            except FileNotFoundError:
+                pass
+
+    async def janitor(self):
+        while True:
+            await asyncio.sleep(max(10, min(300, self.ttl // 4)))
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError as e:
+                print(f"[poligen] Image file sweep failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "stored": self.stored,
+            "expired": self.expired,
+            "ttl": self.ttl,
+        }
+
+
+# ============================================================
+# Memory budget (in-flight image bytes, large bodies spilled to disk)
+# ============================================================
+
+MEMORY_BUDGET_BYTES = 256 * 1024 * 1024  # image bytes in-flight requests may hold, whole process
+MEMORY_MAX_WAIT = 30.0  # seconds a request may wait for budget before 503
+MEMORY_RETRY_AFTER = 10.0  # Retry-After when the budget wait runs out
+MEMORY_BYTES_PER_PIXEL = 0.5  # upstream image size guessed before it arrives
+MEMORY_STREAM_COPIES = 1  # copies of an image held while a b64_json body is streamed
+MEMORY_BUFFER_COPIES = 3  # raw + base64 + JSON, when b64_json bodies are built whole
+SPILL_THRESHOLD = 2 * 1024 * 1024  # bodies larger than this are kept in a temp file, not in memory
+SPILL_DIR = "/root/ai/polligenapi4261/spill"
+
+
+class SpilledImage:
+    # an image body in a file, read back through mmap; a temp file is
+    # removed when its last reference goes, so shared results stay valid
+    def __init__(self, file, size: int):
+        self.file = file
+        self.size = size
+        self.path = file.name
+        self._map: mmap.mmap | None = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def buffer(self) -> mmap.mmap:
+        # page cache backed, not part of the process's own memory
+        if self._map is None:
+            self._map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+
+class MemoryBudget:
+    # byte semaphore in front of generation, requests wait their turn in arrival order
+    def __init__(self, max_bytes: int, max_wait: float):
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.used = 0
+        self.peak = 0
+        self.waiters: deque = deque()  # [nbytes, future]
+        self.reserved = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+    async def reserve(self, nbytes: int, max_wait: float | None = None) -> int:
+        # a request larger than the whole budget runs alone
+        nbytes = min(nbytes, self.max_bytes)
+        if not self.waiters and self.used + nbytes <= self.max_bytes:
+            self._take(nbytes)
+            return nbytes
+
+        waiter = [nbytes, asyncio.get_running_loop().create_future()]
+        self.waiters.append(waiter)
+        self.delayed += 1
+        timeout = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            self._remove(waiter)
+            self.rejected += 1
+            raise AdmissionError("Memory budget exhausted", MEMORY_RETRY_AFTER)
+        except asyncio.CancelledError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release(nbytes)  # granted just before the caller went away
+            else:
+                self._remove(waiter)
+            raise
+        return nbytes
+
+    def release(self, nbytes: int):
+        if nbytes:
+            self.used -= nbytes
+            self._dispatch()
+
+    def hold(self, response: Response, nbytes: int):
+        # released once the body has been sent, or when the response is dropped unsent
+        done = weakref.finalize(response, self.release, nbytes)
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = released_after(response.body_iterator, done)
+        elif response.background is None:
+            response.background = BackgroundTask(done)
+
+    def _take(self, nbytes: int):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        self.reserved += 1
+
+    def _remove(self, waiter: list):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.waiters:
+            nbytes, fut = self.waiters[0]
+            if not fut.done():
+                if self.used + nbytes > self.max_bytes:
+                    return
+                self._take(nbytes)
+                fut.set_result(None)
+            self.waiters.popleft()
+
+    def spill(self, size: int):
+        self.spilled += 1
+        self.spilled_bytes += size
+
+    def stats(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "used_bytes": self.used,
+            "peak_bytes": self.peak,
+            "waiting": len(self.waiters),
+            "reserved": self.reserved,
+            "delayed": self.delayed,
+            "rejected": self.rejected,
+            "spill_threshold": SPILL_THRESHOLD,
+            "spilled": self.spilled,
+            "spilled_bytes": self.spilled_bytes,
+        }
+
+
+async def released_after(chunks: AsyncIterator[bytes], done: Callable[[], None]) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        done()
+
+
+def image_estimate(size: str, count: int) -> int:
+    # budget asked for before any image has arrived
+    parsed = parse_size(size)
+    width, height = parsed if parsed is not None else PollinationsClient.map_size(size)
+    per_image = min(int(width * height * MEMORY_BYTES_PER_PIXEL), SPILL_THRESHOLD)
+    copies = MEMORY_STREAM_COPIES if STREAM_RESPONSES else MEMORY_BUFFER_COPIES
+    return per_image * copies * count
+
+
+def spill_file():
+    # named, so a resize worker can open it; the pid lets startup tell leftovers apart
+    return tempfile.NamedTemporaryFile(dir=SPILL_DIR, prefix=f"{os.getpid()}-", suffix=".img")
+
+
+def clear_spill_dir(root: str):
+    # files of processes that are gone, left by a crash
+    Path(root).mkdir(parents=True, exist_ok=True)
+    for path in Path(root).iterdir():
+        pid = path.name.partition("-")[0]
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except (ValueError, ProcessLookupError):
+            pass
+        except PermissionError:
+            continue
+        path.unlink(missing_ok=True)
+
+
+def image_buffer(img: "bytes | SpilledImage"):
+    return img.buffer() if isinstance(img, SpilledImage) else img
+
+
+# ============================================================
+# Response encoding (streamed base64)
+# ============================================================
+
+STREAM_RESPONSES = True  # stream b64_json bodies while downloading/encoding
+B64_CHUNK = 48 * 1024    # raw bytes per base64 piece, multiple of 3
+
+# an image is its bytes, its bytes spilled to a file, or an upstream response with the body unread
+ImageSource = bytes | SpilledImage | httpx.Response
+
+
+async def image_chunks(img: ImageSource) -> AsyncIterator[bytes]:
+    if isinstance(img, httpx.Response):
+        # only time spent waiting on upstream counts as download
+        download = 0.0
+        started = time.perf_counter()
+        async for chunk in img.aiter_bytes(B64_CHUNK):
+            download += time.perf_counter() - started
+            UPSTREAM_BYTES.inc(len(chunk))
+            yield chunk
+            started = time.perf_counter()
+        PHASE_SECONDS.observe(download + time.perf_counter() - started, PHASE_DOWNLOAD)
+    else:
+        view = memoryview(image_buffer(img))
+        for start in range(0, len(view), B64_CHUNK):
+            yield view[start:start + B64_CHUNK]
+
+
+async def read_image(img: ImageSource) -> bytes | SpilledImage:
+    if isinstance(img, httpx.Response):
+        started = time.perf_counter()
+        try:
+            data = await read_body(img)
+        finally:
+            await img.aclose()
+        PHASE_SECONDS.observe(time.perf_counter() - started, PHASE_DOWNLOAD)
+        UPSTREAM_BYTES.inc(len(data))
+        return data
+    return img
+
+
+async def read_body(resp: httpx.Response) -> bytes | SpilledImage:
+    # kept in memory up to SPILL_THRESHOLD, past it the body goes to a temp file
+    chunks = []
+    size = 0
+    spilled = None
+    try:
+        length = int(resp.headers.get("content-length", ""))
+    except ValueError:
+        length = 0
+    if length > SPILL_THRESHOLD:
+        spilled = spill_file()
+    try:
+        async for chunk in resp.aiter_bytes(B64_CHUNK):
+            size += len(chunk)
+            if spilled is None and size > SPILL_THRESHOLD:
+                spilled = spill_file()
+                spilled.writelines(chunks)
+                chunks = None
+            if spilled is None:
+                chunks.append(chunk)
+            else:
+                spilled.write(chunk)
+    except BaseException:
+        if spilled is not None:
+            spilled.close()
+        raise
+    if spilled is None or not size:
+        return b"".join(chunks or [])
+    spilled.flush()
+    memory.spill(size)
+    return SpilledImage(spilled, size)
+
+
+def encode_b64(data) -> bytes:
+    started = time.perf_counter()
+    encoded = base64.b64encode(data)
+    PHASE_SECONDS.observe(time.perf_counter() - started, PHASE_ENCODE)
+    return encoded
+
+
+async def close_images(images: list):
+    for img in images:
+        if isinstance(img, httpx.Response):
+            await img.aclose()
+
+
+async def stream_b64_envelope(created: int, images: list, errors: list) -> AsyncIterator[bytes]:
+    # same JSON as JSONResponse would send, built one chunk at a time
+    sent = 0
+    try:
+        yield f'{{"created": {created}, "data": ['.encode("utf-8")
+        for n, img in enumerate(images):
+            yield b'{"b64_json": "' if n == 0 else b', {"b64_json": "'
+            encode = 0.0
+            async for chunk in image_chunks(img):
+                started = time.perf_counter()
+                piece = base64.b64encode(chunk)
+                encode += time.perf_counter() - started
+                sent += len(piece)
+                yield piece
+            PHASE_SECONDS.observe(encode, PHASE_ENCODE)
+            yield b'"}'
+            if isinstance(img, httpx.Response):
+                await img.aclose()
+        yield b"]"
+        if errors:
+            yield b', "errors": ' + json.dumps(errors).encode("utf-8")
+        yield b"}"
+    finally:
+        RESPONSE_BYTES.inc(sent)
+        await close_images(images)
+
+
+async def image_response(
+    request: Request,
+    images: list,
+    errors: list,
+    response_format: str,
+) -> Response:
+    created = int(time.time())
+    try:
+        if response_format == "url":
+            base_url = PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+            data = [{"url": await files.publish(img, base_url)} for img in images]
+        elif STREAM_RESPONSES:
+            return StreamingResponse(
+                stream_b64_envelope(created, images, errors),
+                media_type="application/json",
+            )
+        else:
+            data = [
+                {"b64_json": encode_b64(image_buffer(await read_image(img))).decode("utf-8")}
+                for img in images
+            ]
+    except BaseException:
+        await close_images(images)
+        raise
+
+    content = {
+        "created": created,
+        "data": data,
+    }
+    if errors:
+        content["errors"] = errors
+    response = JSONResponse(content=content)
+    RESPONSE_BYTES.inc(len(response.body))
+    return response
+
+
+# ============================================================
+# Post-processing (exact sizes, WebP/JPEG output)
+# ============================================================
+
+RESIZE_ENABLED = True  # needs Pillow, without it sizes map to the native formats as before
+RESIZE_WORKERS = 2  # processes resizing and encoding, off the event loop
+RESIZE_MIN_SIDE = 64
+RESIZE_MAX_SIDE = 2560  # the largest native side, nothing is upscaled past it
+OUTPUT_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+OUTPUT_QUALITY = 90  # when output_compression is not given
+SIZE_RE = re.compile(r"(\d+)x(\d+)")
+
+
+def parse_size(size: str) -> Tuple[int, int] | None:
+    match = SIZE_RE.fullmatch(str(size))
+    if match is None:
+        return None
+    width, height = int(match.group(1)), int(match.group(2))
+    if not (RESIZE_MIN_SIDE <= width <= RESIZE_MAX_SIDE and RESIZE_MIN_SIDE <= height <= RESIZE_MAX_SIDE):
+        return None
+    return width, height
+
+
+def native_format(formats: Dict[str, Tuple[int, int]], width: int, height: int) -> Tuple[int, int]:
+    # smallest native format covering the request, else the closest in shape
+    covering = [f for f in formats.values() if f[0] >= width and f[1] >= height]
+    if covering:
+        return min(covering, key=lambda f: f[0] * f[1])
+    return min(formats.values(), key=lambda f: abs(f[0] / f[1] - width / height))
+
+
+def transcode(data: bytes | str, size: Tuple[int, int] | None, fmt: str | None, quality: int) -> bytes:
+    # runs in a worker process, a spilled image is passed by path
+    with Image.open(data if isinstance(data, str) else io.BytesIO(data)) as img:
+        fmt = fmt or img.format or "JPEG"
+        out_img = img
+        if size is not None and img.size != size:
+            # scale to cover, then crop the middle, like a thumbnail
+            out_img = ImageOps.fit(img, size, Image.LANCZOS)
+        if fmt == "JPEG" and out_img.mode not in ("RGB", "L"):
+            out_img = out_img.convert("RGB")
+        out = io.BytesIO()
+        if fmt == "PNG":
+            out_img.save(out, fmt)
+        else:
+            out_img.save(out, fmt, quality=quality)
+        return out.getvalue()
+
+
+class Resizer:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool: ProcessPoolExecutor | None = None
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def available(self) -> bool:
+        return self.pool is not None
+
+    async def open(self):
+        if not RESIZE_ENABLED or Image is None:
+            return
+        # fork starts every worker on the first submit, before the app has threads
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+        await asyncio.get_running_loop().run_in_executor(self.pool, os.getpid)
+
+    def plan(self, size: str, formats: Dict[str, Tuple[int, int]]) -> Tuple[str, Tuple[int, int] | None]:
+        # (size asked from upstream, exact size to resize to or None)
+        target = parse_size(size) if self.available else None
+        if target is None:
+            return size, None
+        native = native_format(formats, *target)
+        return f"{native[0]}x{native[1]}", (None if native == target else target)
+
+    async def process(self, images: list, size: Tuple[int, int] | None, fmt: str | None, quality: int) -> list:
+        loop = asyncio.get_running_loop()
+
+        async def one(img: ImageSource) -> bytes:
+            data = await read_image(img)
+            started = time.perf_counter()
+            source = data.path if isinstance(data, SpilledImage) else data
+            out = await loop.run_in_executor(self.pool, transcode, source, size, fmt, quality)
+            PHASE_SECONDS.observe(time.perf_counter() - started, PHASE_RESIZE)
+            self.images += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(out)
+            return out
+
+        try:
+            return list(await asyncio.gather(*(one(img) for img in images)))
+        finally:
+            await close_images(images)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.available,
+            "workers": self.workers,
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+# ============================================================
+# Single-flight (coalesce identical in-flight generations)
+# ============================================================
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: Dict[str, list] = {}  # key -> [task, waiters]
+        self.claims: Dict[str, int] = {}    # key -> callers about to start it
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.flights or key in self.claims
+
+    def claim(self, key: str) -> str:
+        # mark a key as taken before its flight task gets to run
+        self.claims[key] = self.claims.get(key, 0) + 1
+        return key
+
+    def release(self, key: str):
+        left = self.claims.get(key, 0) - 1
+        if left > 0:
+            self.claims[key] = left
+        else:
+            self.claims.pop(key, None)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[bytes]]) -> bytes:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = [asyncio.ensure_future(factory()), 0]
+            self.flights[key] = flight
+            flight[0].add_done_callback(lambda _: self._finish(key, flight))
+        else:
+            self.coalesced += 1
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            # shield: one waiter going away must not cancel the shared call
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                # nobody is waiting any more, drop the upstream call
+                self._finish(key, flight)
+                self.abandoned += 1
+                task.cancel()
+
+    def _finish(self, key: str, flight: list):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.flights),
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+# ============================================================
+# Generation concurrency
+# ============================================================
+
+MAX_CONCURRENCY = 8              # upstream generations in flight, whole process
+MAX_CONCURRENCY_PER_REQUEST = 4  # upstream generations in flight, one request
+
+generation_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def describe_error(e: BaseException) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"upstream returned {e.response.status_code}"
+    if isinstance(e, httpx.TimeoutException):
+        return "upstream timeout"
+    if isinstance(e, UpstreamUnavailable):
+        return "upstream unavailable"
+    return str(e) or type(e).__name__
+
+
+@asynccontextmanager
+async def generation_slot(request_slots: asyncio.Semaphore, waited: float = 0.0):
+    # per-request + global slot; waited = time already spent in admission
+    started = time.perf_counter()
+    SLOT_WAITING.inc()
+    try:
+        await request_slots.acquire()
+        try:
+            await generation_slots.acquire()
+        except BaseException:
+            request_slots.release()
+            raise
+    finally:
+        SLOT_WAITING.dec()
+
+    PHASE_SECONDS.observe(waited + time.perf_counter() - started, PHASE_QUEUE_WAIT)
+    UPSTREAM_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        UPSTREAM_IN_FLIGHT.dec()
+        generation_slots.release()
+        request_slots.release()
+
+
+CLIENT_POLL_INTERVAL = 1.0  # seconds between checks that the caller is still there
+
+
+def request_deadline(request: Request) -> float | None:
+    # X-Request-Timeout: seconds the caller will wait, e.g. LiteLLM's timeout
+    try:
+        return time.monotonic() + float(request.headers["x-request-timeout"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def client_gone(request: Request, deadline: float | None) -> str:
+    # returns why the caller no longer wants the result
+    while True:
+        wait = CLIENT_POLL_INTERVAL
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                return "deadline"
+        await asyncio.sleep(wait)
+        if await request.is_disconnected():
+            return "disconnected"
+
+
+async def follow_client(request: Request, work: Awaitable[Response]) -> Response:
+    # work is cancelled (upstream requests, queued images) once the caller is gone
+    task = asyncio.ensure_future(work)
+    watch = asyncio.ensure_future(client_gone(request, request_deadline(request)))
+    try:
+        await asyncio.wait((task, watch), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watch.cancel()
+        raise
+    if task.done():
+        watch.cancel()
+        return task.result()
+
+    reason = watch.result()
+    task.cancel()
+    try:
+        # finished in the meantime after all
+        return await task
+    except asyncio.CancelledError:
+        pass
+    CANCELLED.inc(1, (reason,))
+    if reason == "deadline":
+        return JSONResponse(status_code=504, content={"error": "request deadline exceeded"})
+    return Response(status_code=499)  # nobody is listening, for the logs and metrics
+
+
+# ============================================================
+# Jobs (async=true, polled or followed over SSE)
+# ============================================================
+
+JOBS_TTL = 3600  # seconds a finished job and its result are kept
+JOBS_MAX = 200  # jobs tracked at once, running or finished
+JOBS_MAX_BYTES = 512 * 1024 * 1024  # finished results kept in memory, oldest dropped first
+
+
+class Job:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "queued"  # queued -> running -> succeeded | failed
+        self.created = int(time.time())
+        self.updated = self.created
+        self.status_code: int | None = None
+        self.body: bytes | None = None  # the response the synchronous call would have sent
+        self.task: asyncio.Task | None = None
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def set_status(self, status: str):
+        self.status = status
+        self.updated = int(time.time())
+        # wake every watcher, later ones wait on a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def running(self):
+        if self.status == "queued":
+            self.set_status("running")
+
+    def render(self) -> bytes:
+        head = {
+            "id": self.id,
+            "object": "image.job",
+            "status": self.status,
+            "created": self.created,
+            "updated": self.updated,
+        }
+        if self.status_code is not None:
+            head["status_code"] = self.status_code
+        text = json.dumps(head).encode("utf-8")
+        if self.body is None:
+            return text
+        # the result is already JSON, splice it in instead of re-encoding megabytes
+        return text[:-1] + b', "result": ' + self.body + b"}"
+
+
+async def response_body(response: Response) -> bytes:
+    if isinstance(response, StreamingResponse):
+        chunks = []
+        async for chunk in response.body_iterator:
+            chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+        return b"".join(chunks)
+    return bytes(response.body)
+
+
+class JobStore:
+    def __init__(self, ttl: int, max_jobs: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()  # oldest first
+        self.result_bytes = 0
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def submit(self, run: Callable[[Job], Awaitable[Response]]) -> Job | None:
+        self.sweep()
+        if len(self.jobs) >= self.max_jobs and not self._evict_finished():
+            self.rejected += 1
+            return None
+        job = Job("job_" + secrets.token_hex(16))
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        self.sweep()
+        return self.jobs.get(job_id)
+
+    async def _run(self, job: Job, run: Callable[[Job], Awaitable[Response]]):
+        try:
+            response = await run(job)
+            body = await response_body(response)
+            self._finish(job, response.status_code, body)
+        except asyncio.CancelledError:
+            self._finish(job, 503, json.dumps({"error": "job cancelled"}).encode("utf-8"))
+            raise
+        except Exception as e:
+            self._finish(job, 500, json.dumps({"error": describe_error(e)}).encode("utf-8"))
+
+    def _finish(self, job: Job, status_code: int, body: bytes):
+        job.status_code = status_code
+        job.body = body
+        job.task = None
+        self.result_bytes += len(body)
+        if status_code < 400:
+            self.succeeded += 1
+            job.set_status("succeeded")
+        else:
+            self.failed += 1
+            job.set_status("failed")
+        while self.result_bytes > self.max_bytes and self._evict_finished(keep=job):
+            pass
+
+    def _forget(self, job: Job):
+        del self.jobs[job.id]
+        self.result_bytes -= len(job.body or b"")
+
+    def _evict_finished(self, keep: Job | None = None) -> bool:
+        for job in self.jobs.values():
+            if job.done and job is not keep:
+                self._forget(job)
+                self.evicted += 1
+                return True
+        return False
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for job in [j for j in self.jobs.values() if j.done and j.updated < cutoff]:
+            self._forget(job)
+
+    async def janitor(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            self.sweep()
+
+    def cancel_all(self):
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+
+    def stats(self) -> dict:
+        active = sum(1 for job in self.jobs.values() if not job.done)
+        return {
+            "jobs": len(self.jobs),
+            "active": active,
+            "result_bytes": self.result_bytes,
+            "max_jobs": self.max_jobs,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
+
 
 # ============================================================
-# API key loader (file-based, no env)
+# Batches (JSONL in, NDJSON out, checkpointed to disk)
 # ============================================================
 
-def read_api_key(path: str) -> str | None:
+BATCHES_DIR = "/root/ai/polligenapi4261/batches"
+BATCHES_TTL = 7 * 86400  # seconds a finished batch and its results are kept
+BATCH_MAX_ITEMS = 10000
+BATCH_CONCURRENCY = 4  # batch items generated at once, all batches together
+BATCH_ITEM_ATTEMPTS = 3  # tries of an item failing upstream before its error is recorded
+BATCH_RETRY_DELAY = 30.0  # seconds before trying again when upstream gave no Retry-After
+BATCH_READ_CHUNK = 1024 * 1024
+BATCH_RESULT_RE = re.compile(rb'\{"index": (\d+), "status_code": (\d+)')
+
+
+def batch_request(base_url: str) -> Request:
+    # items run apart from the client's connection, possibly after a restart;
+    # generation only needs the base URL image links are built from
+    url = urlsplit(base_url)
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "scheme": url.scheme or "http",
+        "root_path": url.path.rstrip("/"),
+        "path": "/v1/images/batches",
+        "query_string": b"",
+        "headers": [(b"host", url.netloc.encode("latin-1"))],
+        "client": None,
+        "server": None,
+    })
+
+
+def read_chunk(path: Path, offset: int) -> bytes:
     try:
-        key = Path(path).read_text(encoding="utf-8").strip()
-        return key if key else None
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(BATCH_READ_CHUNK)
     except FileNotFoundError:
-        return None
-    except Exception as e:
-        print(f"[poligen] Failed to read API key file: {e}")
-        return None
+        return b""
 
 
-# ============================================================
-# Rate/Limits tracking
-# ============================================================
+class Batch:
+    def __init__(self, root: Path, meta: dict):
+        self.id = meta["id"]
+        self.root = root
+        self.meta = meta  # id, created, base_url, total, finished
+        self.completed: set = set()  # item indexes with a checkpointed result
+        self.succeeded = 0
+        self.failed = 0
+        self.task: asyncio.Task | None = None
+        self.changed = asyncio.Event()
+
+    @property
+    def results_path(self) -> Path:
+        return self.root / "results.ndjson"
+
+    @property
+    def done(self) -> bool:
+        return len(self.completed) >= self.meta["total"]
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def load(self):
+        # results already checkpointed; a line cut short by a crash is dropped
+        if not self.results_path.exists():
+            return
+        data = self.results_path.read_bytes()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            with open(self.results_path, "r+b") as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            m = BATCH_RESULT_RE.match(line)
+            if m:
+                self._count(int(m.group(1)), int(m.group(2)))
+
+    def read_items(self) -> list:
+        with open(self.root / "items.jsonl", "rb") as f:
+            return [json.loads(line) for line in f]
+
+    def write_meta(self):
+        tmp = self.root / "meta.json.tmp"
+        tmp.write_text(json.dumps(self.meta), encoding="utf-8")
+        os.replace(tmp, self.root / "meta.json")
+
+    def _count(self, index: int, status_code: int):
+        if index in self.completed:
+            return
+        self.completed.add(index)
+        if status_code < 400:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    def _append(self, line: bytes):
+        with open(self.results_path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def record(self, index: int, custom_id, status_code: int, body: bytes):
+        head = json.dumps({"index": index, "status_code": status_code, "custom_id": custom_id}).encode("utf-8")
+        # the response is already JSON, splice it in as for jobs
+        await asyncio.to_thread(self._append, head[:-1] + b', "body": ' + body + b"}\n")
+        self._count(index, status_code)
+        self.notify()
+
+    async def follow(self) -> AsyncIterator[bytes]:
+        # checkpointed results first, then each new one as it is written
+        offset = 0
+        while True:
+            changed = self.changed
+            chunk = await asyncio.to_thread(read_chunk, self.results_path, offset)
+            if chunk:
+                offset += len(chunk)
+                yield chunk
+                continue
+            if self.task is None:
+                return
+            await changed.wait()
+
+    def status(self) -> dict:
+        if self.done:
+            state = "completed"
+        else:
+            state = "running" if self.task is not None else "paused"
+        return {
+            "id": self.id,
+            "object": "image.batch",
+            "status": state,
+            "created": self.meta["created"],
+            "finished": self.meta.get("finished"),
+            "total": self.meta["total"],
+            "completed": len(self.completed),
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+        }
+
 
-TPD_LIMIT = 450  # limit per day
-RPM_LIMIT = 5    # limit per minute
+class BatchStore:
+    def __init__(self, root: str, ttl: int, concurrency: int):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.slots = asyncio.Semaphore(concurrency)
+        self.batches: Dict[str, Batch] = {}
+        self.submitted = 0
+        self.resumed = 0
+        self.retried = 0
 
-last_requests = deque()  # timestamps last queries (for RPM)
-daily_count = 0
-daily_reset = datetime.utcnow() + timedelta(days=1)
+    def open(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        for path in self.root.iterdir():
+            try:
+                meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+                batch = Batch(path, meta)
+                batch.load()
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[poligen] Skipping batch {path.name}: {e}")
+                continue
+            self.batches[batch.id] = batch
+
+    def resume(self):
+        for batch in self.batches.values():
+            if not batch.done:
+                self.resumed += 1
+                self._start(batch)
+
+    async def submit(self, data: bytes, items: list, base_url: str) -> Batch:
+        # the id is the content hash, posting the same JSONL again resumes or replays it
+        batch_id = "batch_" + hashlib.sha256(data).hexdigest()[:32]
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            root = self.root / batch_id
+            batch = Batch(root, {
+                "id": batch_id,
+                "created": int(time.time()),
+                "base_url": base_url,
+                "total": len(items),
+                "finished": None,
+            })
+            lines = b"".join(json.dumps(item).encode("utf-8") + b"\n" for item in items)
+            await asyncio.to_thread(root.mkdir, parents=True, exist_ok=True)
+            await asyncio.to_thread((root / "items.jsonl").write_bytes, lines)
+            await asyncio.to_thread(batch.write_meta)
+            self.batches[batch_id] = batch
+            self.submitted += 1
+        if not batch.done and batch.task is None:
+            self._start(batch)
+        return batch
+
+    def get(self, batch_id: str) -> Batch | None:
+        return self.batches.get(batch_id)
+
+    def _start(self, batch: Batch):
+        batch.task = asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch: Batch):
+        try:
+            items = await asyncio.to_thread(batch.read_items)
+            pending = iter([i for i in range(len(items)) if i not in batch.completed])
+
+            async def worker():
+                for index in pending:
+                    async with self.slots:
+                        await self._item(batch, index, items[index])
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            batch.meta["finished"] = int(time.time())
+            await asyncio.to_thread(batch.write_meta)
+        except Exception as e:
+            print(f"[poligen] Batch {batch.id} stopped: {describe_error(e)}")
+        finally:
+            batch.task = None
+            batch.notify()
+
+    async def _item(self, batch: Batch, index: int, item: dict):
+        body = {k: v for k, v in item.items() if k != "custom_id"}
+        request = batch_request(batch.meta["base_url"])
+        attempt = 0
+        while True:
+            try:
+                response = await run_generation(request, body, background=True)
+                status_code, data = response.status_code, await response_body(response)
+            except Exception as e:
+                response = None
+                status_code, data = 500, json.dumps({"error": describe_error(e)}).encode("utf-8")
+
+            if status_code == 503:
+                # refused by the limits (daily quota, open breaker): wait, it is not the item's fault
+                delay = BATCH_RETRY_DELAY
+                if response is not None and "retry-after" in response.headers:
+                    delay = float(response.headers["retry-after"])
+                await asyncio.sleep(delay)
+                continue
+            attempt += 1
+            if status_code >= 500 and attempt < BATCH_ITEM_ATTEMPTS:
+                self.retried += 1
+                await asyncio.sleep(BATCH_RETRY_DELAY)
+                continue
+            break
+        await batch.record(index, item.get("custom_id"), status_code, data)
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for batch in [b for b in self.batches.values() if b.meta.get("finished") and b.meta["finished"] < cutoff]:
+            del self.batches[batch.id]
+            shutil.rmtree(batch.root, ignore_errors=True)
+
+    async def janitor(self):
+        while True:
+            await asyncio.sleep(3600)
+            await asyncio.to_thread(self.sweep)
+
+    def cancel_all(self):
+        for batch in self.batches.values():
+            if batch.task is not None:
+                batch.task.cancel()
+
+    def stats(self) -> dict:
+        active = [b for b in self.batches.values() if b.task is not None]
+        return {
+            "batches": len(self.batches),
+            "active": len(active),
+            "pending_items": sum(b.meta["total"] - len(b.completed) for b in active),
+            "submitted": self.submitted,
+            "resumed": self.resumed,
+            "retried_items": self.retried,
+            "ttl": self.ttl,
+        }
 
 
 # ============================================================
 # Pollinations client
 # ============================================================
 
+POOL_MAX_CONNECTIONS = MAX_CONCURRENCY * 2  # streamed bodies outlive their generation slot
+POOL_MAX_KEEPALIVE = MAX_CONCURRENCY
+POOL_KEEPALIVE_EXPIRY = 120.0  # seconds an idle connection is kept open
+POOL_HTTP2 = True  # multiplex over one connection, needs the h2 package
+POOL_PREWARM = 2  # connections opened at startup, 0 = off
+POOL_PREWARM_TIMEOUT = 10.0
+
+HEDGE_ENABLED = False  # opt-in, every hedge is a second upstream generation
+HEDGE_PERCENTILE = 0.95  # hedge requests slower than this share of recent ones
+HEDGE_MIN_SAMPLES = 20  # latencies needed before the percentile is trusted
+HEDGE_MIN_DELAY = 5.0  # never hedge earlier than this, seconds
+HEDGE_WINDOW = 200  # recent latencies the percentile is taken from
+HEDGE_BUDGET = 0.1  # hedges per minute / per UTC day, as a share of RPM / TPD
+
+BREAKER_FAILURES = 5  # consecutive upstream failures that open the circuit
+BREAKER_OPEN_SECONDS = 30.0  # first wait before a probe request is let through
+BREAKER_MAX_OPEN_SECONDS = 300.0  # the wait doubles after each failed probe, up to this
+TIMEOUT_MAX = 600.0  # generation timeout before enough latencies are known
+TIMEOUT_MIN = 60.0
+TIMEOUT_PERCENTILE = 0.99  # per model and size
+TIMEOUT_FACTOR = 3.0  # timeout = percentile latency * factor, within MIN..MAX
+TIMEOUT_MIN_SAMPLES = 20
+TIMEOUT_WINDOW = 200  # recent latencies kept per model and size
+TIMEOUT_MAX_KEYS = 50  # model/size combinations tracked, least recent dropped
+
+
+class UpstreamUnavailable(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("upstream unavailable (circuit open)")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int, open_seconds: float, max_open_seconds: float):
+        self.threshold = failures
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = "closed"  # closed -> open -> half_open -> closed | open
+        self.failures = 0  # consecutive
+        self.opened_at = 0.0
+        self.open_for = open_seconds
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    def available(self) -> bool:
+        if self.state == "open" and time.monotonic() >= self.opened_at + self.open_for:
+            self.state = "half_open"
+        return self.state == "closed" or (self.state == "half_open" and not self.probing)
+
+    def retry_after(self) -> int:
+        if self.state != "open":
+            return 1
+        return max(1, int(self.opened_at + self.open_for - time.monotonic() + 0.999))
+
+    def acquire(self) -> bool:
+        # True = this request is the half-open probe
+        if not self.available():
+            self.rejected += 1
+            raise UpstreamUnavailable(self.retry_after())
+        if self.state == "half_open":
+            self.probing = True
+            return True
+        return False
+
+    def record(self, ok: bool, probe: bool):
+        if probe:
+            self.probing = False
+        if ok:
+            self.state = "closed"
+            self.failures = 0
+            self.open_for = self.open_seconds
+            return
+        self.failures += 1
+        if probe or self.state == "half_open":
+            self._trip(min(self.max_open_seconds, self.open_for * 2))
+        elif self.state == "closed" and self.failures >= self.threshold:
+            self._trip(self.open_seconds)
+
+    def release(self, probe: bool):
+        # cancelled before an answer, no verdict
+        if probe:
+            self.probing = False
+
+    def _trip(self, open_for: float):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.open_for = open_for
+        self.trips += 1
+
+    def stats(self) -> dict:
+        self.available()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_after": self.retry_after() if self.state == "open" else None,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class LatencyTracker:
+    # recent time-to-first-byte per (model, size), the image is generated before it
+    def __init__(self):
+        self.samples: "OrderedDict[tuple, deque]" = OrderedDict()
+
+    def observe(self, key: tuple, seconds: float):
+        window = self.samples.get(key)
+        if window is None:
+            window = self.samples[key] = deque(maxlen=TIMEOUT_WINDOW)
+            if len(self.samples) > TIMEOUT_MAX_KEYS:
+                self.samples.popitem(last=False)
+        else:
+            self.samples.move_to_end(key)
+        window.append(seconds)
+
+    def percentile(self, key: tuple, q: float) -> float | None:
+        window = self.samples.get(key)
+        if window is None or len(window) < TIMEOUT_MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        return ordered[int(q * (len(ordered) - 1))]
+
+    def timeout(self, key: tuple) -> float:
+        latency = self.percentile(key, TIMEOUT_PERCENTILE)
+        if latency is None:
+            return TIMEOUT_MAX
+        return min(TIMEOUT_MAX, max(TIMEOUT_MIN, latency * TIMEOUT_FACTOR))
+
+    def stats(self) -> dict:
+        stats = {}
+        for key, window in self.samples.items():
+            p50 = self.percentile(key, 0.5)
+            p99 = self.percentile(key, TIMEOUT_PERCENTILE)
+            stats[" ".join(key)] = {
+                "samples": len(window),
+                "p50": round(p50, 3) if p50 is not None else None,
+                "p99": round(p99, 3) if p99 is not None else None,
+                "timeout": round(self.timeout(key), 1),
+            }
+        return stats
+
+
+class HedgePolicy:
+    def __init__(self, percentile: float, budget: float, limiter=None, scheduler=None):
+        self.percentile = percentile
+        self.budget = budget
+        self.limiter = limiter  # hedges are charged like any other generation
+        self.scheduler = scheduler
+        self.samples: deque = deque(maxlen=HEDGE_WINDOW)
+        self.requests: deque = deque()  # start times, last minute
+        self.hedged: deque = deque()  # hedge times, last minute
+        self.day = utc_day(time.time())
+        self.today = 0
+        self.hedges = 0
+        self.wins = 0
+        self.denied = 0
+
+    def delay(self) -> float | None:
+        # None = not enough history yet, wait without hedging
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return max(HEDGE_MIN_DELAY, ordered[int(self.percentile * (len(ordered) - 1))])
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def started(self):
+        now = time.time()
+        self.requests.append(now)
+        self._trim(now)
+
+    def _trim(self, now: float):
+        for window in (self.requests, self.hedged):
+            while window and window[0] < now - 60:
+                window.popleft()
+
+    def allow(self) -> bool:
+        now = time.time()
+        self._trim(now)
+        if utc_day(now) != self.day:
+            self.day = utc_day(now)
+            self.today = 0
+
+        if self.limiter is not None:
+            per_minute = self.budget * self.limiter.capacity
+            per_day = self.budget * self.limiter.tpd
+        else:
+            per_minute = self.budget * len(self.requests)
+            per_day = float("inf")
+        if len(self.hedged) >= per_minute or self.today >= per_day:
+            self.denied += 1
+            return False
+
+        if self.limiter is not None:
+            # only spare capacity: nobody queued, a token free right now
+            try:
+                if self.scheduler.queued or self.limiter.acquire(1):
+                    self.denied += 1
+                    return False
+            except AdmissionError:
+                self.denied += 1
+                return False
+
+        self.hedged.append(now)
+        self.today += 1
+        self.hedges += 1
+        return True
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {
+            "percentile": self.percentile,
+            "delay": round(delay, 3) if delay is not None else None,
+            "samples": len(self.samples),
+            "budget": self.budget,
+            "hedges": self.hedges,
+            "hedges_today": self.today,
+            "wins": self.wins,
+            "denied": self.denied,
+        }
+
 class PollinationsClient:
     BASE_URL = "https://gen.pollinations.ai/image/"
     API_KEY_PATH = "/root/ai/polligenapi4261/pollinations.key"
@@ -82,8 +2371,24 @@ class PollinationsClient:
         "1440x2560": "portrait_large",
     }
 
-    def __init__(self):
-        self.api_key = read_api_key(self.API_KEY_PATH)
+    def __init__(
+        self,
+        base_url: str | None = None,
+        api_key_path: str | None = API_KEY_PATH,
+        cache: ImageCache | None = None,
+        flights: SingleFlight | None = None,
+        hedge: HedgePolicy | None = None,
+        api_key: str | None = None,
+    ):
+        if base_url:
+            self.BASE_URL = base_url
+        self.hedge = hedge
+        self.on_response: Callable[[httpx.Response], None] | None = None  # sees every upstream answer
+        if api_key is None and api_key_path:
+            api_key = read_api_key(api_key_path)
+        self.api_key = api_key
+        self.cache = cache
+        self.flights = flights if flights is not None else SingleFlight()
 
         headers = {
             "User-Agent": "poligen/1.0",
@@ -93,33 +2398,99 @@ class PollinationsClient:
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
 
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_OPEN_SECONDS, BREAKER_MAX_OPEN_SECONDS)
+        self.latencies = LatencyTracker()
+        self.http2 = POOL_HTTP2 and h2 is not None
+        self.requests = 0
+        self.connects = 0
+        self.transport = httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            ),
+        )
         self.client = httpx.AsyncClient(
+            transport=self.transport,
             follow_redirects=True,
-            timeout=httpx.Timeout(600.0),
+            timeout=httpx.Timeout(TIMEOUT_MAX),
             headers=headers,
         )
 
-    def map_size(self, size: str) -> Tuple[int, int]:
-        fmt = self.SIZE_MAP.get(size, "landscape")
-        return self.FORMATS[fmt]
+    @classmethod
+    def map_size(cls, size: str) -> Tuple[int, int]:
+        fmt = cls.SIZE_MAP.get(size, "landscape")
+        return cls.FORMATS[fmt]
+
+    @classmethod
+    def cache_key(
+        cls,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int,
+    ) -> str:
+        width, height = cls.map_size(size)
+        return ImageCache.make_key(prompt, width, height, model, enhance, seed)
 
-    async def generate_image_b64(
+    async def generate_image(
         self,
         prompt: str,
         size: str = "1920x1080",
         model: str = "klein",
         enhance: bool = True,
         seed: int | None = None,
-    ) -> str:
+    ) -> bytes | SpilledImage:
+        if seed is None:
+            data = await self.fetch_image(prompt, size, model, enhance, None)
+        else:
+            key = self.cache_key(prompt, size, model, enhance, seed)
+            data = await self.flights.do(
+                key,
+                lambda: self._generate_seeded(key, prompt, size, model, enhance, seed),
+            )
+        return data
+
+    async def generate_image_b64(self, *args, **kwargs) -> str:
+        data = await self.generate_image(*args, **kwargs)
+        return base64.b64encode(image_buffer(data)).decode("utf-8")
+
+    async def _generate_seeded(
+        self,
+        key: str,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int,
+    ) -> bytes | SpilledImage:
+        # a flight that just finished may have filled the cache meanwhile
+        if self.cache is not None:
+            data = await self.cache.get(key, record=False)
+            if data is not None:
+                return data
+
+        data = await self.fetch_image(prompt, size, model, enhance, seed)
+        if self.cache is not None:
+            await self.cache.put(key, data)
+        return data
+
+    def _image_request(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> httpx.Request:
         width, height = self.map_size(size)
 
+        deterministic = seed is not None
         if seed is None:
             seed = random.randint(0, 999999)
 
-        nonce = random.randint(100000, 999999)
-        safe_prompt = quote(f"{prompt}::{nonce}", safe="")
-        url = f"{self.BASE_URL}{safe_prompt}"
-
         params = {
             "width": width,
             "height": height,
@@ -127,32 +2498,576 @@ class PollinationsClient:
             "nologo": "true",
             "enhance": str(enhance).lower(),
             "seed": seed,
-            "t": int(time.time()),
         }
 
-        resp = await self.client.get(url, params=params)
-        resp.raise_for_status()
+        if deterministic:
+            # same seed + params must give the same image, no cache busting
+            safe_prompt = quote(prompt, safe="")
+        else:
+            nonce = random.randint(100000, 999999)
+            safe_prompt = quote(f"{prompt}::{nonce}", safe="")
+            params["t"] = int(time.time())
+
+        url = f"{self.BASE_URL}{safe_prompt}"
+
+        return self.client.build_request("GET", url, params=params)
+
+    async def open_image(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> httpx.Response:
+        # status checked, body left unread for the caller to stream
+        request = self._image_request(prompt, size, model, enhance, seed)
+        if self.hedge is None:
+            return await self._send(request)
+        return await self._send_hedged(request)
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        probe = self.breaker.acquire()
+        params = request.url.params
+        key = (params.get("model", ""), f"{params.get('width')}x{params.get('height')}")
+        # generation happens before the first byte, so the read timeout bounds it
+        request.extensions["timeout"] = {**request.extensions.get("timeout", {}), "read": self.latencies.timeout(key)}
+        connect_started = 0.0
+
+        async def trace(event: str, info: dict):
+            nonlocal connect_started
+            if event == "connection.connect_tcp.started":
+                connect_started = time.perf_counter()
+                self.connects += 1
+            elif connect_started and (
+                event == "connection.start_tls.complete"
+                or (event == "connection.connect_tcp.complete" and request.url.scheme == "http")
+            ):
+                PHASE_SECONDS.observe(time.perf_counter() - connect_started, PHASE_CONNECT)
+
+        request.extensions["trace"] = trace
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            resp = await self.client.send(request, stream=True)
+        except httpx.TransportError:
+            self.breaker.record(False, probe)
+            raise
+        except BaseException:
+            self.breaker.release(probe)
+            raise
+        elapsed = time.perf_counter() - started
+        PHASE_SECONDS.observe(elapsed, PHASE_TTFB)
+        if self.on_response is not None:
+            self.on_response(resp)
+        if resp.is_error:
+            # 4xx and 429 mean the upstream is up
+            self.breaker.record(resp.status_code < 500, probe)
+            await resp.aclose()
+            resp.raise_for_status()
+        self.breaker.record(True, probe)
+        self.latencies.observe(key, elapsed)
+        return resp
+
+    async def _send_hedged(self, request: httpx.Request) -> httpx.Response:
+        # past the learned percentile, race a duplicate and keep the first answer
+        policy = self.hedge
+        policy.started()
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(self._send(request))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=policy.delay())
+            if not done and policy.allow():
+                # same URL, so the same seed and model
+                duplicate = httpx.Request(
+                    request.method, request.url, headers=request.headers, extensions=dict(request.extensions)
+                )
+                tasks.append(asyncio.create_task(self._send(duplicate)))
+
+            error = None
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = winner or task
+                    else:
+                        error = error or task.exception()
+            if winner is None:
+                raise error
+
+            policy.observe(time.perf_counter() - started)
+            if winner is not tasks[0]:
+                policy.wins += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    await task.result().aclose()
+
+    async def fetch_image(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> bytes | SpilledImage:
+        resp = await self.open_image(prompt, size, model, enhance, seed)
+        return await read_image(resp)
+
+    async def prewarm(self, connections: int = POOL_PREWARM) -> int:
+        # pay DNS, TCP and TLS before the first image request does
+        parts = urlsplit(self.BASE_URL)
+        origin = f"{parts.scheme}://{parts.netloc}/"
+
+        async def touch():
+            await self.client.head(origin, timeout=POOL_PREWARM_TIMEOUT)
+
+        # HTTP/2 is negotiated over TLS only, one connection then carries every request
+        count = 1 if self.http2 and parts.scheme == "https" else connections
+        await asyncio.gather(*(touch() for _ in range(count)), return_exceptions=True)
+        return len(self.pool_connections())
 
-        return base64.b64encode(resp.content).decode("utf-8")
+    def pool_connections(self) -> list:
+        # httpx keeps the httpcore pool private, read it defensively
+        pool = getattr(self.transport, "_pool", None)
+        return list(getattr(pool, "connections", ()))
+
+    def pool_stats(self) -> dict:
+        connections = self.pool_connections()
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            "http2": self.http2,
+            "max_connections": POOL_MAX_CONNECTIONS,
+            "max_keepalive": POOL_MAX_KEEPALIVE,
+            "keepalive_expiry": POOL_KEEPALIVE_EXPIRY,
+            "open": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle,
+            "http2_connections": sum(1 for c in connections if "HTTP/2" in c.info()),
+            "requests": self.requests,
+            "connects": self.connects,
+            "reuse_ratio": round(1.0 - min(self.connects, self.requests) / self.requests, 4) if self.requests else None,
+        }
 
     async def close(self):
         await self.client.aclose()
 
 
+# ============================================================
+# Upstream backends and routing
+# ============================================================
+
+# "models": models served natively ("*" = any)
+# "fallback_model": model used when another backend spills over here
+# "rpm"/"tpd": limits of the backend, None = not limited; the RPM is where
+#   the adaptive rate starts (ADAPTIVE_ENABLED)
+# "api_key_path": key file; with several keys in it the backend becomes
+#   one backend per key ("paid-<name>"), each with its own limits
+BACKENDS = [
+    {
+        "name": "paid",
+        "base_url": "https://gen.pollinations.ai/image/",
+        "api_key_path": "/root/ai/polligenapi4261/pollinations.key",
+        "models": ["*"],
+        "fallback_model": None,
+        "rpm": RPM_LIMIT,
+        "tpd": TPD_LIMIT,
+    },
+    {
+        "name": "free",
+        "base_url": "https://image.pollinations.ai/prompt/",
+        "api_key_path": None,
+        "models": ["flux", "turbo"],
+        "fallback_model": "flux",
+        "rpm": FREE_RPM_LIMIT,
+        "tpd": None,
+    },
+]
+
+HEALTH_ALPHA = 0.2             # EWMA weight of the newest sample
+HEALTH_DEFAULT_LATENCY = 15.0  # seconds, assumed before the first sample
+HEALTH_ERROR_PENALTY = 4.0     # score multiplier per unit of error rate
+
+KEYS_RELOAD_INTERVAL = 10.0  # seconds between key file checks
+KEYS_RETIRE_GRACE = TIMEOUT_MAX  # a removed key's requests may finish before it is closed
+KEY_COOLDOWN_AUTH = 3600.0  # a key answered 401, probably revoked or mistyped
+KEY_COOLDOWN_RATE = 60.0  # a key answered 429 without Retry-After
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    # worth retrying on another backend (not a bad request), 401 = another key may work
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in (401, 429) or e.response.status_code >= 500
+    return isinstance(e, (httpx.TransportError, UpstreamUnavailable))
+
+
+def expand_keys(conf: dict) -> list:
+    # one backend conf per key in the key file, unkeyed backends as they are
+    path = conf.get("api_key_path")
+    if not path:
+        return [{**conf, "api_key": None, "key_id": None}]
+    keys = read_api_keys(path)
+    if not keys:
+        return [{**conf, "api_key": None, "key_id": None}]
+
+    confs = []
+    for entry in keys:
+        key_id = key_fingerprint(entry["key"])
+        name = conf["name"]
+        if len(keys) > 1 or "name" in entry:
+            name = f"{name}-{entry.get('name') or key_id}"
+        confs.append({
+            **conf,
+            "name": name,
+            "api_key": entry["key"],
+            "key_id": key_id,
+            "rpm": entry.get("rpm", conf.get("rpm")),
+            "tpd": entry.get("tpd", conf.get("tpd")),
+        })
+    return confs
+
+
+class Backend:
+    def __init__(self, conf: dict, cache: ImageCache | None, flights: SingleFlight):
+        self.name = conf["name"]
+        self.models = set(conf.get("models") or ["*"])
+        self.fallback_model = conf.get("fallback_model")
+        self.key_id = conf.get("key_id")
+        self.client = PollinationsClient(
+            base_url=conf["base_url"],
+            api_key_path=None,
+            api_key=conf.get("api_key"),
+            cache=cache,
+            flights=flights,
+        )
+
+        self.limiter = None
+        self.scheduler = None
+        if conf.get("rpm") or conf.get("tpd"):
+            self.limiter = make_limiter(
+                self.name,
+                conf.get("rpm") or 10**6,
+                conf.get("tpd") or 10**9,
+            )
+            self.scheduler = AdmissionScheduler(self.limiter, QUEUE_MAX, QUEUE_MAX_WAIT)
+        self.adaptive = None
+        if ADAPTIVE_ENABLED and self.limiter is not None and conf.get("rpm"):
+            self.adaptive = AdaptiveRate(self.limiter, conf["rpm"], self.saturated)
+            self.client.on_response = self.adaptive.observe
+        if HEDGE_ENABLED:
+            self.client.hedge = HedgePolicy(HEDGE_PERCENTILE, HEDGE_BUDGET, self.limiter, self.scheduler)
+
+        self.latency: float | None = None  # EWMA seconds of successful calls
+        self.error_rate = 0.0              # EWMA of failed calls
+        self.successes = 0
+        self.failures = 0
+        self.cooldown_until = 0.0  # monotonic time the key may be used again
+        self.cooldowns = 0
+        self.retired_at: float | None = None
+
+    def open(self):
+        if self.limiter is not None:
+            self.limiter.open()
+
+    async def close(self):
+        if self.limiter is not None:
+            self.limiter.close()
+        await self.client.close()
+
+    def set_limits(self, rpm: int | None, tpd: int | None):
+        # new limits from a reloaded key file, usage so far is kept
+        if self.limiter is None:
+            return
+        self.limiter.max_units = rpm or 10**6
+        self.limiter.tpd = tpd or 10**9
+        if self.adaptive is not None and rpm:
+            if rpm != self.adaptive.seed:
+                # a new configured rate, learning starts over from it
+                self.adaptive.seed = float(rpm)
+                self.adaptive.set_rpm(rpm)
+        else:
+            self.limiter.set_rpm(rpm or 10**6)
+
+    def saturated(self) -> bool:
+        # requests are waiting for the limiter, more rate would be used
+        return bool(self.scheduler.queued) or self.limiter.state()["tokens"] < 1.0
+
+    def cool_down(self, e: BaseException):
+        # a key refused by upstream rests instead of burning more requests
+        if not self.key_id or not isinstance(e, httpx.HTTPStatusError):
+            return
+        status = e.response.status_code
+        if status == 401:
+            seconds = KEY_COOLDOWN_AUTH
+        elif status == 429:
+            seconds = retry_after_seconds(e.response) or KEY_COOLDOWN_RATE
+        else:
+            return
+        until = time.monotonic() + seconds
+        if until > self.cooldown_until:
+            self.cooldown_until = until
+            self.cooldowns += 1
+            print(f"[poligen] {self.name}: upstream answered {status}, key cooling down for {seconds:.0f}s")
+
+    def cooldown_left(self) -> float:
+        return max(0.0, self.cooldown_until - time.monotonic())
+
+    def model_for(self, model: str) -> Tuple[str | None, bool]:
+        # (upstream model, served natively)
+        if model in self.models or "*" in self.models:
+            return model, True
+        return self.fallback_model, False
+
+    def record(self, ok: bool, elapsed: float):
+        if ok:
+            self.successes += 1
+            self.latency = elapsed if self.latency is None else (
+                HEALTH_ALPHA * elapsed + (1 - HEALTH_ALPHA) * self.latency
+            )
+        else:
+            self.failures += 1
+        self.error_rate = HEALTH_ALPHA * (0.0 if ok else 1.0) + (1 - HEALTH_ALPHA) * self.error_rate
+
+    def quota_left(self) -> float:
+        if self.limiter is None:
+            return 1.0
+        state = self.limiter.state()
+        return max(0.0, 1.0 - state["daily_count"] / self.limiter.tpd)
+
+    def headroom(self) -> float:
+        # the tighter of the RPM bucket and the daily quota, as a share left
+        if self.limiter is None:
+            return 1.0
+        tokens = self.limiter.state()["tokens"] / self.limiter.capacity
+        return max(0.0, min(tokens, self.quota_left()))
+
+    def admission_wait(self) -> float:
+        # seconds one more unit would queue for RPM tokens
+        return self.scheduler.estimate_wait(1) if self.scheduler is not None else 0.0
+
+    def score(self) -> float:
+        # expected seconds per image, inflated by errors and a draining key
+        latency = self.latency if self.latency is not None else HEALTH_DEFAULT_LATENCY
+        score = latency * (1.0 + HEALTH_ERROR_PENALTY * self.error_rate)
+        return score / max(self.headroom(), 0.05)
+
+    async def admit(self, request: Request, body: dict, units: int, background: bool = False):
+        if self.scheduler is not None and units and background:
+            await self.scheduler.acquire_background(units)
+        elif self.scheduler is not None and units:
+            await self.scheduler.acquire(
+                request_user(request, body),
+                units,
+                request_max_wait(request),
+            )
+
+    def stats(self) -> dict:
+        stats = {
+            "base_url": self.client.BASE_URL,
+            "api_key": bool(self.client.api_key),
+            "key": self.key_id,
+            "headroom": round(self.headroom(), 3),
+            "cooldown": round(self.cooldown_left(), 1),
+            "cooldowns": self.cooldowns,
+            "latency_ewma": round(self.latency, 3) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "successes": self.successes,
+            "failures": self.failures,
+            "score": round(self.score(), 3),
+            "pool": self.client.pool_stats(),
+            "hedge": self.client.hedge.stats() if self.client.hedge is not None else None,
+            "breaker": self.client.breaker.state,
+            "adaptive": self.adaptive.stats() if self.adaptive is not None else None,
+        }
+        if self.limiter is not None:
+            stats["limits"] = {
+                "rpm_limit": round(self.limiter.capacity, 2),
+                "tpd_limit": self.limiter.tpd,
+                **self.limiter.state(),
+                **self.scheduler.stats(),
+            }
+        return stats
+
+
+class Router:
+    def __init__(self, confs: list, cache: ImageCache | None, flights: SingleFlight):
+        self.confs = confs
+        self.cache = cache
+        self.flights = flights
+        self.key_mtimes = self._key_mtimes()
+        self.backends = [Backend(c, cache, flights) for conf in confs for c in expand_keys(conf)]
+        self.retired: list = []  # removed keys, closed after KEYS_RETIRE_GRACE
+
+    def _key_mtimes(self) -> dict:
+        mtimes = {}
+        for conf in self.confs:
+            path = conf.get("api_key_path")
+            if path:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtimes[path] = None
+        return mtimes
+
+    def reload_keys(self) -> bool:
+        # new keys get a backend, removed ones retire, kept ones take their new limits
+        mtimes = self._key_mtimes()
+        if mtimes == self.key_mtimes:
+            return False
+        self.key_mtimes = mtimes
+
+        current = {backend.name: backend for backend in self.backends}
+        backends = []
+        for conf in self.confs:
+            for key_conf in expand_keys(conf):
+                backend = current.pop(key_conf["name"], None)
+                if backend is not None and backend.key_id == key_conf["key_id"]:
+                    backend.set_limits(key_conf.get("rpm"), key_conf.get("tpd"))
+                else:
+                    if backend is not None:
+                        self.retire(backend)
+                    backend = Backend(key_conf, self.cache, self.flights)
+                    backend.open()
+                    if backend.adaptive is not None:
+                        load_rates(ADAPTIVE_STATE_PATH, {backend.name: backend.adaptive})
+                    print(f"[poligen] {backend.name}: key added")
+                backends.append(backend)
+        for backend in current.values():
+            self.retire(backend)
+        self.backends = backends
+        return True
+
+    def retire(self, backend: Backend):
+        print(f"[poligen] {backend.name}: key removed")
+        backend.retired_at = time.monotonic()
+        self.retired.append(backend)
+
+    async def close_retired(self, grace: float):
+        now = time.monotonic()
+        for backend in [b for b in self.retired if now - b.retired_at >= grace]:
+            self.retired.remove(backend)
+            await backend.close()
+
+    async def watch_keys(self):
+        while True:
+            await asyncio.sleep(KEYS_RELOAD_INTERVAL)
+            try:
+                self.reload_keys()
+            except Exception as e:
+                print(f"[poligen] Key file reload failed: {e}")
+            await self.close_retired(KEYS_RETIRE_GRACE)
+
+    def rates(self) -> Dict[str, AdaptiveRate]:
+        return {b.name: b.adaptive for b in self.backends if b.adaptive is not None}
+
+    async def keep_rates(self):
+        # learned rates are saved, so a restart does not start over
+        while True:
+            await asyncio.sleep(ADAPTIVE_SAVE_INTERVAL)
+            rates = self.rates()
+            if any(rate.dirty for rate in rates.values()):
+                try:
+                    await asyncio.to_thread(save_rates, ADAPTIVE_STATE_PATH, rates)
+                except OSError as e:
+                    print(f"[poligen] Failed to save adaptive rates: {e}")
+
+    async def close(self):
+        rates = self.rates()
+        if rates:
+            try:
+                save_rates(ADAPTIVE_STATE_PATH, rates)
+            except OSError as e:
+                print(f"[poligen] Failed to save adaptive rates: {e}")
+        for backend in self.backends:
+            await backend.close()
+        await self.close_retired(0.0)
+
+    def candidates(self, model: str) -> list:
+        # native backends first, then spill-over targets; a key that can
+        # admit right away before one that would queue; healthiest first
+        ranked = []
+        for backend in self.backends:
+            upstream_model, native = backend.model_for(model)
+            if upstream_model:
+                waits = backend.admission_wait() > 0
+                ranked.append((not native, waits, backend.score(), backend, upstream_model))
+        ranked.sort(key=lambda r: r[:3])
+        return [(backend, upstream_model) for *_, backend, upstream_model in ranked]
+
+
 # ============================================================
 # FastAPI app
 # ============================================================
 
-client = PollinationsClient()
+cache = ImageCache(CACHE_DIR, CACHE_MAX_BYTES) if CACHE_ENABLED else None
+files = ImageStore(FILES_DIR, FILES_TTL, FILES_SECRET_PATH)
+jobs = JobStore(JOBS_TTL, JOBS_MAX, JOBS_MAX_BYTES)
+batches = BatchStore(BATCHES_DIR, BATCHES_TTL, BATCH_CONCURRENCY)
+resizer = Resizer(RESIZE_WORKERS)
+memory = MemoryBudget(MEMORY_BUDGET_BYTES, MEMORY_MAX_WAIT)
+flights = SingleFlight()
+router = Router(BACKENDS, cache, flights)
+
+def use_upstream(origin: str):
+    # point every backend at another host (a mirror, the bench mock), keeping its path
+    origin = origin.rstrip("/")
+    for conf in router.confs:
+        conf["base_url"] = origin + urlsplit(conf["base_url"]).path
+    for backend in router.backends:
+        backend.client.BASE_URL = origin + urlsplit(backend.client.BASE_URL).path
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    if client.api_key:
-        print("[poligen] Pollinations API key loaded (paid mode)")
-    else:
-        print("[poligen] No API key found (free mode)")
+    await resizer.open()
+    for backend in router.backends:
+        if backend.client.api_key:
+            print(f"[poligen] {backend.name}: Pollinations API key loaded (paid mode)")
+        else:
+            print(f"[poligen] {backend.name}: no API key (free mode)")
+        backend.open()
+        if backend.limiter is not None:
+            used = backend.limiter.state()["daily_count"]
+            print(f"[poligen] {backend.name}: rate limiter {LIMITER_BACKEND}, {used}/{backend.limiter.tpd} used today")
+    load_rates(ADAPTIVE_STATE_PATH, router.rates())
+    for name, rate in router.rates().items():
+        print(f"[poligen] {name}: adaptive rate {rate.rpm:.1f} RPM (configured {rate.seed:g})")
+    if POOL_HTTP2 and h2 is None:
+        print('[poligen] HTTP/2 unavailable (pip install "httpx[http2]"), using HTTP/1.1')
+    if POOL_PREWARM:
+        warmed = await asyncio.gather(*(backend.client.prewarm() for backend in router.backends))
+        for backend, count in zip(router.backends, warmed):
+            print(f"[poligen] {backend.name}: {count} upstream connections pre-warmed")
+    if cache is not None:
+        await asyncio.to_thread(cache.load)
+        print(f"[poligen] Image cache: {len(cache.entries)} entries, {cache.total_bytes} bytes")
+    await asyncio.to_thread(files.open)
+    await asyncio.to_thread(clear_spill_dir, SPILL_DIR)
+    janitor = asyncio.create_task(files.janitor())
+    jobs_janitor = asyncio.create_task(jobs.janitor())
+    await asyncio.to_thread(batches.open)
+    batches.resume()
+    batches_janitor = asyncio.create_task(batches.janitor())
+    lag_watch = asyncio.create_task(watch_loop_lag())
+    key_watch = asyncio.create_task(router.watch_keys())
+    rates_saver = asyncio.create_task(router.keep_rates())
     yield
-    await client.close()
+    rates_saver.cancel()
+    key_watch.cancel()
+    lag_watch.cancel()
+    jobs_janitor.cancel()
+    jobs.cancel_all()
+    batches_janitor.cancel()
+    batches.cancel_all()
+    janitor.cancel()
+    resizer.close()
+    await router.close()
 
 app = FastAPI(
     title="Pollinations OpenAI Image Proxy",
@@ -165,66 +3080,441 @@ app = FastAPI(
 
 @app.post("/v1/images/generations")
 async def image_generation(request: Request):
-    global daily_count, daily_reset, last_requests
-
     body = await request.json()
+    if request.query_params.get("async", "").lower() in ("1", "true", "yes"):
+        job = jobs.submit(lambda job: run_generation(request, body, job.running))
+        if job is None:
+            return JSONResponse(status_code=503, content={"error": "too many jobs, try again later"})
+        return Response(
+            job.render(),
+            status_code=202,
+            media_type="application/json",
+            headers={"Location": f"/v1/images/jobs/{job.id}"},
+        )
+    return await run_generation(request, body, follow=True)
+
+
+async def run_generation(
+    request: Request,
+    body: dict,
+    on_running: Callable[[], None] | None = None,
+    background: bool = False,
+    follow: bool = False,
+) -> Response:
+    model = model_label(body.get("model", "klein"))
+
+    IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        work = generate_images(request, body, on_running, background)
+        # a synchronous caller may leave; jobs and batches run on without one
+        response = await (follow_client(request, work) if follow else work)
+        status = response.status_code
+        return response
+    finally:
+        IN_FLIGHT.dec()
+        REQUESTS.inc(1, (str(status), model))
+        REQUEST_SECONDS.observe(time.perf_counter() - started, (model,))
+
+
+async def generate_images(
+    request: Request,
+    body: dict,
+    on_running: Callable[[], None] | None = None,
+    background: bool = False,
+) -> Response:
     prompt = body.get("prompt")
     if not prompt:
         return JSONResponse(status_code=400, content={"error": "prompt required"})
 
-    size = body.get("size", "1920x1080")
-    model = body.get("model", "klein")
-    n = int(body.get("n", 1))
-
-    # --- limits ---
-    now = datetime.utcnow()
-    if now >= daily_reset:
-        daily_count = 0
-        daily_reset = now + timedelta(days=1)
+    response_format = body.get("response_format") or "b64_json"
+    if response_format not in ("b64_json", "url"):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "response_format must be 'b64_json' or 'url'"},
+        )
 
-    # check TPD
-    if daily_count >= TPD_LIMIT:
+    output_format = body.get("output_format")
+    if output_format is not None and not resizer.available:
+        return JSONResponse(status_code=400, content={"error": "output_format is not available on this server"})
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
         return JSONResponse(
-            status_code=503,
-            content={"error": "Daily limit exceeded"}
+            status_code=400,
+            content={"error": "output_format must be 'png', 'jpeg' or 'webp'"},
         )
+    quality = body.get("output_compression")
+    quality = OUTPUT_QUALITY if quality is None else min(100, max(1, int(quality)))
+
+    # exact sizes are cut from the nearest larger native format
+    size, resize = resizer.plan(body.get("size", "1920x1080"), PollinationsClient.FORMATS)
+    model = body.get("model", "klein")
+    n = max(1, int(body.get("n", 1)))
+    enhance = bool(body.get("enhance", True))
+    seed = body.get("seed")
 
-    # check RPM
-    while last_requests and (now - last_requests[0]).total_seconds() > 60:
-        last_requests.popleft()
+    # explicit seed -> deterministic images, one seed per image
+    seeds = [None] * n if seed is None else [int(seed) + i for i in range(n)]
 
-    if len(last_requests) >= RPM_LIMIT:
+    # --- memory budget (waits while other requests hold too many image bytes) ---
+    try:
+        held = await memory.reserve(image_estimate(size, n), request_max_wait(request))
+    except AdmissionError as e:
         return JSONResponse(
             status_code=503,
-            content={"error": "Rate limit exceeded"}
+            content={"error": str(e)},
+            headers=retry_after_header(e.retry_after),
         )
 
-    # query registration
-    last_requests.append(now)
-    daily_count += 1
-
-    # --- generation ---
-    images = []
-    for _ in range(max(1, n)):
-        img_b64 = await client.generate_image_b64(
-            prompt=prompt,
-            size=size,
-            model=model,
-        )
-        images.append({"b64_json": img_b64})
+    try:
+        # --- cache (hits never touch the limits) ---
+        images = []
+        for s in seeds:
+            img = None
+            if cache is not None and s is not None:
+                key = PollinationsClient.cache_key(prompt, size, model, enhance, s)
+                img = await cache.get(key)
+            images.append(img)
 
-    return JSONResponse(
-        content={
-            "created": int(time.time()),
-            "data": images,
-        }
+        # --- routing: try backends in order until every image is done ---
+        pending = [i for i, img in enumerate(images) if img is None]
+        errors: Dict[int, str] = {}
+        throttled: Dict[int, float] = {}  # images whose last failure was a 429, -> Retry-After
+        refused: AdmissionError | None = None
+
+        for backend, upstream_model in router.candidates(model):
+            if not pending:
+                break
+
+            # images already being generated for another caller are shared, not charged
+            keys = {
+                i: PollinationsClient.cache_key(prompt, size, upstream_model, enhance, seeds[i])
+                for i in pending
+                if seeds[i] is not None
+            }
+            charged = [i for i in pending if keys.get(i) not in flights]
+
+            if backend.cooldown_left():
+                # the key was refused upstream, it is not tried again until it has rested
+                refused = refused or AdmissionError(f"{backend.name}: key cooling down", backend.cooldown_left())
+                continue
+
+            if not backend.client.breaker.available():
+                # failing fast, nothing is charged while the upstream is down
+                refused = refused or AdmissionError(
+                    f"{backend.name}: upstream unavailable", backend.client.breaker.retry_after()
+                )
+                continue
+
+            # --- limits (one unit per upstream generation) ---
+            admit_started = time.perf_counter()
+            try:
+                await backend.admit(request, body, len(charged), background)
+            except AdmissionError as e:
+                refused = refused or e
+                continue
+            admission_wait = time.perf_counter() - admit_started
+            if on_running is not None:
+                on_running()
+
+            # concurrent callers with the same seeds now share instead of paying again
+            claims = [flights.claim(keys[i]) for i in charged if i in keys]
+
+            # --- generation (concurrent, results keep request order) ---
+            request_slots = asyncio.Semaphore(MAX_CONCURRENCY_PER_REQUEST)
+            sent = set()
+            opened = []
+
+            async def generate(i: int) -> ImageSource:
+                async with generation_slot(request_slots, admission_wait):
+                    sent.add(i)
+                    started = time.monotonic()
+                    try:
+                        if STREAM_RESPONSES and seeds[i] is None:
+                            # nothing to cache or share, stream the body through
+                            img = await backend.client.open_image(
+                                prompt, size, upstream_model, enhance, None
+                            )
+                        else:
+                            img = await backend.client.generate_image(
+                                prompt=prompt,
+                                size=size,
+                                model=upstream_model,
+                                enhance=enhance,
+                                seed=seeds[i],
+                            )
+                    except Exception as e:
+                        if is_upstream_failure(e):
+                            backend.record(False, time.monotonic() - started)
+                            backend.cool_down(e)
+                        raise
+                    backend.record(True, time.monotonic() - started)
+                    opened.append(img)
+                    return img
+
+            try:
+                results = await asyncio.gather(
+                    *(generate(i) for i in pending),
+                    return_exceptions=True,
+                )
+            except asyncio.CancelledError:
+                # the caller left: images that never went upstream are refunded
+                unsent = sum(1 for i in charged if i not in sent)
+                if unsent and backend.scheduler is not None:
+                    backend.scheduler.release(unsent)
+                await close_images(opened)
+                raise
+            finally:
+                for key in claims:
+                    flights.release(key)
+
+            retry = []
+            for i, result in zip(pending, results):
+                if isinstance(result, BaseException):
+                    print(f"[poligen] {backend.name}: image {i} failed: {describe_error(result)}")
+                    errors[i] = f"{backend.name}: {describe_error(result)}"
+                    throttled.pop(i, None)
+                    if isinstance(result, httpx.HTTPStatusError) and result.response.status_code == 429:
+                        throttled[i] = retry_after_seconds(result.response) or 60.0
+                    if is_upstream_failure(result):
+                        retry.append(i)
+                else:
+                    images[i] = result
+                    errors.pop(i, None)
+                    throttled.pop(i, None)
+            pending = retry
+
+        ready = [img for img in images if img is not None]
+        if not ready:
+            if refused is not None and not errors:
+                return JSONResponse(
+                    status_code=refused.status_code,
+                    content={"error": str(refused)},
+                    headers=retry_after_header(refused.retry_after) if refused.status_code == 503 else None,
+                )
+            if errors and len(throttled) == len(errors):
+                # upstream is rate limiting us, say so and when to come back
+                return JSONResponse(
+                    status_code=503,
+                    content={
+                        "error": "upstream rate limited",
+                        "errors": [{"index": i, "error": e} for i, e in sorted(errors.items())],
+                    },
+                    headers=retry_after_header(max(throttled.values())),
+                )
+            return JSONResponse(
+                status_code=502,
+                content={
+                    "error": "Image generation failed",
+                    "errors": [{"index": i, "error": e} for i, e in sorted(errors.items())],
+                }
+            )
+
+        failed = [
+            {"index": i, "error": errors.get(i, str(refused) if refused else "not generated")}
+            for i, img in enumerate(images)
+            if img is None
+        ]
+        if resize is not None or output_format is not None:
+            ready = await resizer.process(ready, resize, OUTPUT_FORMATS.get(output_format), quality)
+        response = await image_response(request, ready, failed, response_format)
+        # the budget goes back once the body has been sent
+        memory.hold(response, held)
+        held = 0
+        return response
+    finally:
+        memory.release(held)
+
+
+# ============================================================
+# Image jobs
+# ============================================================
+
+@app.get("/v1/images/jobs/{job_id}")
+async def image_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found or expired"})
+    return Response(job.render(), media_type="application/json")
+
+
+@app.get("/v1/images/jobs/{job_id}/events")
+async def image_job_events(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found or expired"})
+
+    async def events():
+        # one event per state change, the last one ("done") carries the result
+        while not job.done:
+            changed = job.changed
+            yield {"event": job.status, "data": job.render().decode("utf-8")}
+            await changed.wait()
+        yield {"event": "done", "data": job.render().decode("utf-8")}
+
+    return EventSourceResponse(events())
+
+
+# ============================================================
+# Image batches
+# ============================================================
+
+@app.post("/v1/images/batches")
+async def image_batch(request: Request):
+    data = await request.body()
+    items = []
+    for number, line in enumerate(data.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"error": f"line {number}: invalid JSON"})
+        if not isinstance(item, dict) or not item.get("prompt"):
+            return JSONResponse(status_code=400, content={"error": f"line {number}: prompt required"})
+        items.append(item)
+    if not items:
+        return JSONResponse(status_code=400, content={"error": "batch is empty"})
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(status_code=400, content={"error": f"batch exceeds {BATCH_MAX_ITEMS} items"})
+
+    batch = await batches.submit(data, items, PUBLIC_BASE_URL or str(request.base_url).rstrip("/"))
+    return StreamingResponse(
+        batch.follow(),
+        media_type="application/x-ndjson",
+        headers={"Location": f"/v1/images/batches/{batch.id}", "X-Batch-Id": batch.id},
+    )
+
+
+@app.get("/v1/images/batches/{batch_id}")
+async def image_batch_status(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse(status_code=404, content={"error": "batch not found or expired"})
+    return batch.status()
+
+
+@app.get("/v1/images/batches/{batch_id}/results")
+async def image_batch_results(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse(status_code=404, content={"error": "batch not found or expired"})
+    return StreamingResponse(batch.follow(), media_type="application/x-ndjson")
+
+
+# ============================================================
+# Image files
+# ============================================================
+
+@app.get("/v1/images/files/{file_id}")
+async def image_file(file_id: str, expires: int = 0, sig: str = ""):
+    status, path = files.resolve(file_id, expires, sig)
+    if path is None:
+        errors = {403: "invalid signature", 404: "not found", 410: "link expired"}
+        return JSONResponse(status_code=status, content={"error": errors[status]})
+
+    return FileResponse(
+        path,
+        media_type=MEDIA_TYPES.get(path.suffix[1:], "application/octet-stream"),
+        headers={"Cache-Control": f"private, max-age={max(0, expires - int(time.time()))}"},
     )
 
 
+# ============================================================
+# Proxy stats
+# ============================================================
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def update_metrics():
+    if cache is not None:
+        CACHE_HITS.set(cache.hits)
+        CACHE_MISSES.set(cache.misses)
+        CACHE_BYTES.set(cache.total_bytes)
+    COALESCED.set(flights.coalesced)
+    MEMORY_USED.set(memory.used)
+    MEMORY_WAITING.set(len(memory.waiters))
+    SPILLED_BYTES.set(memory.spilled_bytes)
+
+    for backend in router.backends:
+        key = (backend.name,)
+        BACKEND_LATENCY.set(backend.latency or 0.0, key)
+        BACKEND_ERRORS.set(backend.error_rate, key)
+        BREAKER_STATE.set(BREAKER_STATES[backend.client.breaker.stats()["state"]], key)
+        pool = backend.client.pool_stats()
+        POOL_CONNECTIONS.set(pool["idle"], (backend.name, "idle"))
+        POOL_CONNECTIONS.set(pool["active"], (backend.name, "active"))
+        POOL_CONNECTS.set(pool["connects"], key)
+        POOL_REQUESTS.set(pool["requests"], key)
+        if backend.adaptive is not None:
+            ADAPTIVE_RPM.set(backend.adaptive.rpm, key)
+        if backend.limiter is None:
+            continue
+        state = backend.limiter.state()
+        RPM_TOKENS.set(state["tokens"], key)
+        DAILY_COUNT.set(state["daily_count"], key)
+        DAILY_LIMIT.set(backend.limiter.tpd, key)
+        ADMISSION_QUEUE.set(backend.scheduler.queued, key)
+        REJECTIONS.set(backend.scheduler.rejected_daily, (backend.name, "daily"))
+        REJECTIONS.set(backend.scheduler.rejected_full, (backend.name, "queue_full"))
+        REJECTIONS.set(backend.scheduler.rejected_timeout, (backend.name, "timeout"))
+
+
+@app.get("/metrics")
+async def metrics():
+    update_metrics()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@app.get("/status")
+async def status():
+    return {
+        "upstreams": [
+            {
+                "name": backend.name,
+                "base_url": backend.client.BASE_URL,
+                "breaker": backend.client.breaker.stats(),
+                "timeouts": backend.client.latencies.stats(),
+            }
+            for backend in router.backends
+        ],
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "limiter_backend": LIMITER_BACKEND,
+        "backends": {b.name: b.stats() for b in router.backends},
+        "retired_backends": [b.name for b in router.retired],
+        "cache": cache.stats() if cache is not None else None,
+        "files": files.stats(),
+        "jobs": jobs.stats(),
+        "batches": batches.stats(),
+        "cancelled": {reason: int(count) for (reason,), count in CANCELLED.values.items()},
+        "resize": resizer.stats(),
+        "memory": memory.stats(),
+        "singleflight": flights.stats(),
+    }
+
+
 # ============================================================
 # Local run
 # ============================================================
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=4261)
+
+    parser = argparse.ArgumentParser(description="Pollinations OpenAI-compatible image proxy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4261)
+    parser.add_argument("--upstream", help="send image requests to this origin instead, e.g. http://127.0.0.1:9100")
+    args = parser.parse_args()
+    if args.upstream:
+        use_upstream(args.upstream)
+    uvicorn.run(app, host=args.host, port=args.port)
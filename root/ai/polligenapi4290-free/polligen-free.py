@@ -14,24 +14,1409 @@
 # along with this program. If not, see <https://www.gnu.org>.
 
 
+import io
+import os
+import re
+import hmac
+import json
 import random
 import time
 import base64
+import bisect
 import asyncio
+import hashlib
+import secrets
+import tempfile
+import multiprocessing
 import httpx
 
 from pathlib import Path
-from typing import Dict, Tuple
-from urllib.parse import quote
+from typing import AsyncIterator, Awaitable, Callable, Dict, Tuple
+from urllib.parse import quote, urlsplit
 from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+from email.utils import parsedate_to_datetime
 
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from sse_starlette.sse import EventSourceResponse
+
+try:
+    import h2  # HTTP/2 support for httpx, pip install "httpx[http2]"
+except ImportError:
+    h2 = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+# ============================================================
+# Image cache (content-addressed, seed-deterministic requests)
+# ============================================================
+
+CACHE_ENABLED = True
+CACHE_DIR = "/root/ai/polligenapi4290-free/cache"
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+
+
+class ImageCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size, LRU first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(
+        prompt: str,
+        width: int,
+        height: int,
+        model: str,
+        enhance: bool,
+        seed: int,
+    ) -> str:
+        raw = json.dumps(
+            [prompt, width, height, model, bool(enhance), int(seed)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def load(self):
+        # rebuild LRU index from disk, oldest mtime first
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        for path in self.root.glob("*/*"):
+            if path.suffix == ".tmp":
+                path.unlink(missing_ok=True)  # leftover of an interrupted write
+                continue
+            st = path.stat()
+            found.append((st.st_mtime, path.name, st.st_size))
+
+        found.sort()
+        self.entries.clear()
+        self.total_bytes = 0
+        for _, key, size in found:
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _read(self, key: str) -> bytes:
+        path = self.path_for(key)
+        data = path.read_bytes()
+        os.utime(path)  # keep LRU order across restarts
+        return data
+
+    def _write(self, key: str, data: bytes):
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def _forget(self, key: str):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            self.path_for(key).unlink(missing_ok=True)
+
+    async def get(self, key: str, record: bool = True) -> bytes | None:
+        data = None
+        if key in self.entries:
+            try:
+                data = await asyncio.to_thread(self._read, key)
+            except FileNotFoundError:
+                self._forget(key)
+
+        if data is not None and key in self.entries:
+            self.entries.move_to_end(key)
+
+        if record:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.hit_bytes += len(data)
+        return data
+
+    async def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError as e:
+            print(f"[poligen-free] Cache write failed: {e}")
+            return
+
+        self._forget(key)
+        self.entries[key] = len(data)
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            await asyncio.to_thread(self._evict)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "hit_bytes": self.hit_bytes,
+            "evictions": self.evictions,
+        }
+
+
+# ============================================================
+# Metrics (Prometheus text format)
+# ============================================================
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag probes
+METRICS_MAX_MODELS = 20  # distinct model label values before "other"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name: str, labels: tuple, key: tuple, value: float) -> str:
+    if value == int(value):
+        value = int(value)
+    if not labels:
+        return f"{name} {value}"
+    pairs = ",".join(f'{label}="{escape_label(str(v))}"' for label, v in zip(labels, key))
+    return f"{name}{{{pairs}}} {value}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}  # label values -> value
+
+    def inc(self, amount: float = 1.0, key: tuple = ()):
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, value: float, key: tuple = ()):
+        # mirror a value kept elsewhere, updated at scrape time
+        self.values[key] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(format_sample(self.name, self.labels, key, value))
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, key: tuple = ()):
+        self.values[key] = self.values.get(key, 0.0) - amount
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.values: Dict[tuple, list] = {}  # label values -> [bucket counts, sum]
+
+    def observe(self, value: float, key: tuple = ()):
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        labels = self.labels + ("le",)
+        for key, (counts, total) in self.values.items():
+            running = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                lines.append(format_sample(f"{self.name}_bucket", labels, key + (bound,), running))
+            lines.append(format_sample(f"{self.name}_sum", self.labels, key, round(total, 6)))
+            lines.append(format_sample(f"{self.name}_count", self.labels, key, running))
+        return lines
+
+
+# phase keys are built once, observing one allocates nothing
+PHASE_QUEUE_WAIT = ("queue_wait",)
+PHASE_CONNECT = ("connect",)
+PHASE_TTFB = ("ttfb",)
+PHASE_DOWNLOAD = ("download",)
+PHASE_ENCODE = ("encode",)
+PHASE_RESIZE = ("resize",)
+
+REQUESTS = Counter("poligen_requests_total", "Image generation requests.", ("status", "model"))
+REQUEST_SECONDS = Histogram("poligen_request_duration_seconds", "Image generation handler latency.", ("model",))
+PHASE_SECONDS = Histogram("poligen_phase_duration_seconds", "Per-image latency by phase.", ("phase",))
+UPSTREAM_BYTES = Counter("poligen_upstream_bytes_total", "Image bytes downloaded from upstream.")
+RESPONSE_BYTES = Counter("poligen_response_bytes_total", "Image response body bytes sent to clients.")
+IN_FLIGHT = Gauge("poligen_requests_in_flight", "Image generation requests being handled.")
+UPSTREAM_IN_FLIGHT = Gauge("poligen_upstream_in_flight", "Upstream generations running.")
+SLOT_WAITING = Gauge("poligen_slot_queue_depth", "Images waiting for a concurrency slot.")
+LOOP_LAG = Histogram("poligen_event_loop_lag_seconds", "Event loop scheduling delay.", buckets=LOOP_LAG_BUCKETS)
+LOOP_LAG_MAX = Gauge("poligen_event_loop_lag_max_seconds", "Largest event loop delay seen since start.")
+CANCELLED = Counter("poligen_cancelled_total", "Requests cancelled because the caller left.", ("reason",))
+
+# mirrored from the proxy's own counters at scrape time
+CACHE_HITS = Counter("poligen_cache_hits_total", "Seeded images served from the disk cache.")
+CACHE_MISSES = Counter("poligen_cache_misses_total", "Seeded images not found in the disk cache.")
+CACHE_BYTES = Gauge("poligen_cache_bytes", "Bytes stored in the disk cache.")
+COALESCED = Counter("poligen_coalesced_total", "Generations shared with an identical in-flight one.")
+BREAKER_STATE = Gauge("poligen_breaker_state", "Circuit breaker: 0 closed, 1 half-open, 2 open.")
+POOL_CONNECTIONS = Gauge("poligen_upstream_connections", "Pooled upstream connections.", ("state",))
+POOL_CONNECTS = Counter("poligen_upstream_connects_total", "Upstream connections opened by requests.")
+POOL_REQUESTS = Counter("poligen_upstream_requests_total", "Upstream image requests sent.")
+ADAPTIVE_RPM = Gauge("poligen_adaptive_rpm", "Learned upstream requests per minute.")
+RATE_TOKENS = Gauge("poligen_rpm_tokens", "RPM tokens left in the bucket.")
+
+METRICS = [
+    REQUESTS, REQUEST_SECONDS, PHASE_SECONDS, UPSTREAM_BYTES, RESPONSE_BYTES,
+    IN_FLIGHT, UPSTREAM_IN_FLIGHT, SLOT_WAITING, LOOP_LAG, LOOP_LAG_MAX, CANCELLED,
+    CACHE_HITS, CACHE_MISSES, CACHE_BYTES, COALESCED,
+    BREAKER_STATE, POOL_CONNECTIONS, POOL_CONNECTS, POOL_REQUESTS, ADAPTIVE_RPM, RATE_TOKENS,
+]
+
+metric_models: set = set()
+
+
+def model_label(model) -> str:
+    # bounded label set, clients choose the model string
+    model = str(model)
+    if model in metric_models:
+        return model
+    if len(metric_models) < METRICS_MAX_MODELS:
+        metric_models.add(model)
+        return model
+    return "other"
+
+
+async def watch_loop_lag():
+    # a sleep that wakes late means something blocked the loop
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(lag)
+        if lag > LOOP_LAG_MAX.values.get((), 0.0):
+            LOOP_LAG_MAX.set(lag)
+
+
+# ============================================================
+# Image files (response_format="url")
+# ============================================================
+
+FILES_DIR = "/root/ai/polligenapi4290-free/files"
+FILES_TTL = 3600  # seconds a returned image URL stays valid
+FILES_SECRET_PATH = "/root/ai/polligenapi4290-free/files.secret"  # URL signing key, created on first start
+PUBLIC_BASE_URL = None  # e.g. "https://img.example.com", None = taken from the request
+
+IMAGE_TYPES = {
+    b"\x89PNG": ("png", "image/png"),
+    b"\xff\xd8\xff": ("jpg", "image/jpeg"),
+    b"RIFF": ("webp", "image/webp"),
+    b"GIF8": ("gif", "image/gif"),
+}
+MEDIA_TYPES = {ext: media_type for ext, media_type in IMAGE_TYPES.values()}
+FILE_ID_RE = re.compile(r"[A-Za-z0-9_-]{8,64}\.(png|jpg|webp|gif)")
+
+
+def sniff_image(data: bytes) -> Tuple[str, str]:
+    for magic, kind in IMAGE_TYPES.items():
+        if data.startswith(magic):
+            return kind
+    return "jpg", "image/jpeg"
+
+
+class ImageStore:
+    def __init__(self, root: str, ttl: int, secret_path: str):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.secret_path = Path(secret_path)
+        self.secret = b""
+        self.stored = 0
+        self.expired = 0
+
+    def open(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        try:
+            self.secret = bytes.fromhex(self.secret_path.read_text(encoding="utf-8").strip())
+        except (FileNotFoundError, ValueError):
+            # shared by all workers, so it lives in a file rather than in memory
+            self.secret = os.urandom(32)
+            fd = os.open(self.secret_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.secret.hex())
+
+    def sign(self, file_id: str, expires: int) -> str:
+        msg = f"{file_id}:{expires}".encode("utf-8")
+        return hmac.new(self.secret, msg, hashlib.sha256).hexdigest()[:32]
+
+    async def publish(self, img: "ImageSource", base_url: str) -> str:
+        # written chunk by chunk, so upstream bodies never sit in memory whole
+        file_id = None
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in image_chunks(img):
+                    if file_id is None:
+                        ext, _ = sniff_image(bytes(chunk[:16]))
+                        file_id = f"{secrets.token_urlsafe(16)}.{ext}"
+                    f.write(chunk)
+            if file_id is None:
+                raise ValueError("empty image")
+            os.replace(tmp, self.root / file_id)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        finally:
+            if isinstance(img, httpx.Response):
+                await img.aclose()
+        self.stored += 1
+
+        expires = int(time.time()) + self.ttl
+        sig = self.sign(file_id, expires)
+        return f"{base_url}/v1/images/files/{file_id}?expires={expires}&sig={sig}"
+
+    def resolve(self, file_id: str, expires: int, sig: str) -> Tuple[int, Path | None]:
+        # (http status, path)
+        if not FILE_ID_RE.fullmatch(file_id):
+            return 404, None
+        if not hmac.compare_digest(self.sign(file_id, expires), sig):
+            return 403, None
+        if expires < time.time():
+            return 410, None
+        path = self.root / file_id
+        if not path.is_file():
+            return 404, None
+        return 200, path
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for path in self.root.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+                    self.expired += 1
+            except FileNotFoundError:
+                pass
+
+    async def janitor(self):
+        while True:
+            await asyncio.sleep(max(10, min(300, self.ttl // 4)))
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError as e:
+                print(f"[poligen-free] Image file sweep failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "stored": self.stored,
+            "expired": self.expired,
+            "ttl": self.ttl,
+        }
+
+
+# ============================================================
+# Response encoding (streamed base64)
+# ============================================================
+
+STREAM_RESPONSES = True  # stream b64_json bodies while downloading/encoding
+B64_CHUNK = 48 * 1024    # raw bytes per base64 piece, multiple of 3
+
+# an image is either its bytes or an upstream response with the body unread
+ImageSource = bytes | httpx.Response
+
+
+async def image_chunks(img: ImageSource) -> AsyncIterator[bytes]:
+    if isinstance(img, httpx.Response):
+        # only time spent waiting on upstream counts as download
+        download = 0.0
+        started = time.perf_counter()
+        async for chunk in img.aiter_bytes(B64_CHUNK):
+            download += time.perf_counter() - started
+            UPSTREAM_BYTES.inc(len(chunk))
+            yield chunk
+            started = time.perf_counter()
+        PHASE_SECONDS.observe(download + time.perf_counter() - started, PHASE_DOWNLOAD)
+    else:
+        view = memoryview(img)
+        for start in range(0, len(view), B64_CHUNK):
+            yield view[start:start + B64_CHUNK]
+
+
+async def read_image(img: ImageSource) -> bytes:
+    if isinstance(img, httpx.Response):
+        started = time.perf_counter()
+        try:
+            data = await img.aread()
+        finally:
+            await img.aclose()
+        PHASE_SECONDS.observe(time.perf_counter() - started, PHASE_DOWNLOAD)
+        UPSTREAM_BYTES.inc(len(data))
+        return data
+    return img
+
+
+def encode_b64(data) -> bytes:
+    started = time.perf_counter()
+    encoded = base64.b64encode(data)
+    PHASE_SECONDS.observe(time.perf_counter() - started, PHASE_ENCODE)
+    return encoded
+
+
+async def close_images(images: list):
+    for img in images:
+        if isinstance(img, httpx.Response):
+            await img.aclose()
+
+
+async def stream_b64_envelope(created: int, images: list, errors: list) -> AsyncIterator[bytes]:
+    # same JSON as JSONResponse would send, built one chunk at a time
+    sent = 0
+    try:
+        yield f'{{"created": {created}, "data": ['.encode("utf-8")
+        for n, img in enumerate(images):
+            yield b'{"b64_json": "' if n == 0 else b', {"b64_json": "'
+            encode = 0.0
+            async for chunk in image_chunks(img):
+                started = time.perf_counter()
+                piece = base64.b64encode(chunk)
+                encode += time.perf_counter() - started
+                sent += len(piece)
+                yield piece
+            PHASE_SECONDS.observe(encode, PHASE_ENCODE)
+            yield b'"}'
+            if isinstance(img, httpx.Response):
+                await img.aclose()
+        yield b"]"
+        if errors:
+            yield b', "errors": ' + json.dumps(errors).encode("utf-8")
+        yield b"}"
+    finally:
+        RESPONSE_BYTES.inc(sent)
+        await close_images(images)
+
+
+async def image_response(
+    request: Request,
+    images: list,
+    errors: list,
+    response_format: str,
+) -> Response:
+    created = int(time.time())
+    try:
+        if response_format == "url":
+            base_url = PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+            data = [{"url": await files.publish(img, base_url)} for img in images]
+        elif STREAM_RESPONSES:
+            return StreamingResponse(
+                stream_b64_envelope(created, images, errors),
+                media_type="application/json",
+            )
+        else:
+            data = [
+                {"b64_json": encode_b64(await read_image(img)).decode("utf-8")}
+                for img in images
+            ]
+    except BaseException:
+        await close_images(images)
+        raise
+
+    content = {
+        "created": created,
+        "data": data,
+    }
+    if errors:
+        content["errors"] = errors
+    response = JSONResponse(content=content)
+    RESPONSE_BYTES.inc(len(response.body))
+    return response
+
+
+# ============================================================
+# Post-processing (exact sizes, WebP/JPEG output)
+# ============================================================
+
+RESIZE_ENABLED = True  # needs Pillow, without it sizes map to the native formats as before
+RESIZE_WORKERS = 2  # processes resizing and encoding, off the event loop
+RESIZE_MIN_SIDE = 64
+RESIZE_MAX_SIDE = 2560  # the largest native side, nothing is upscaled past it
+OUTPUT_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+OUTPUT_QUALITY = 90  # when output_compression is not given
+SIZE_RE = re.compile(r"(\d+)x(\d+)")
+
+
+def parse_size(size: str) -> Tuple[int, int] | None:
+    match = SIZE_RE.fullmatch(str(size))
+    if match is None:
+        return None
+    width, height = int(match.group(1)), int(match.group(2))
+    if not (RESIZE_MIN_SIDE <= width <= RESIZE_MAX_SIDE and RESIZE_MIN_SIDE <= height <= RESIZE_MAX_SIDE):
+        return None
+    return width, height
+
+
+def native_format(formats: Dict[str, Tuple[int, int]], width: int, height: int) -> Tuple[int, int]:
+    # smallest native format covering the request, else the closest in shape
+    covering = [f for f in formats.values() if f[0] >= width and f[1] >= height]
+    if covering:
+        return min(covering, key=lambda f: f[0] * f[1])
+    return min(formats.values(), key=lambda f: abs(f[0] / f[1] - width / height))
+
+
+def transcode(data: bytes, size: Tuple[int, int] | None, fmt: str | None, quality: int) -> bytes:
+    # runs in a worker process
+    with Image.open(io.BytesIO(data)) as img:
+        fmt = fmt or img.format or "JPEG"
+        out_img = img
+        if size is not None and img.size != size:
+            # scale to cover, then crop the middle, like a thumbnail
+            out_img = ImageOps.fit(img, size, Image.LANCZOS)
+        if fmt == "JPEG" and out_img.mode not in ("RGB", "L"):
+            out_img = out_img.convert("RGB")
+        out = io.BytesIO()
+        if fmt == "PNG":
+            out_img.save(out, fmt)
+        else:
+            out_img.save(out, fmt, quality=quality)
+        return out.getvalue()
+
+
+class Resizer:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool: ProcessPoolExecutor | None = None
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def available(self) -> bool:
+        return self.pool is not None
+
+    async def open(self):
+        if not RESIZE_ENABLED or Image is None:
+            return
+        # fork starts every worker on the first submit, before the app has threads
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+        await asyncio.get_running_loop().run_in_executor(self.pool, os.getpid)
+
+    def plan(self, size: str, formats: Dict[str, Tuple[int, int]]) -> Tuple[str, Tuple[int, int] | None]:
+        # (size asked from upstream, exact size to resize to or None)
+        target = parse_size(size) if self.available else None
+        if target is None:
+            return size, None
+        native = native_format(formats, *target)
+        return f"{native[0]}x{native[1]}", (None if native == target else target)
+
+    async def process(self, images: list, size: Tuple[int, int] | None, fmt: str | None, quality: int) -> list:
+        loop = asyncio.get_running_loop()
+
+        async def one(img: ImageSource) -> bytes:
+            data = await read_image(img)
+            started = time.perf_counter()
+            out = await loop.run_in_executor(self.pool, transcode, data, size, fmt, quality)
+            PHASE_SECONDS.observe(time.perf_counter() - started, PHASE_RESIZE)
+            self.images += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(out)
+            return out
+
+        try:
+            return list(await asyncio.gather(*(one(img) for img in images)))
+        finally:
+            await close_images(images)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.available,
+            "workers": self.workers,
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+# ============================================================
+# Single-flight (coalesce identical in-flight generations)
+# ============================================================
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: Dict[str, list] = {}  # key -> [task, waiters]
+        self.claims: Dict[str, int] = {}    # key -> callers about to start it
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.flights or key in self.claims
+
+    def claim(self, key: str) -> str:
+        # mark a key as taken before its flight task gets to run
+        self.claims[key] = self.claims.get(key, 0) + 1
+        return key
+
+    def release(self, key: str):
+        left = self.claims.get(key, 0) - 1
+        if left > 0:
+            self.claims[key] = left
+        else:
+            self.claims.pop(key, None)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[bytes]]) -> bytes:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = [asyncio.ensure_future(factory()), 0]
+            self.flights[key] = flight
+            flight[0].add_done_callback(lambda _: self._finish(key, flight))
+        else:
+            self.coalesced += 1
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            # shield: one waiter going away must not cancel the shared call
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                # nobody is waiting any more, drop the upstream call
+                self._finish(key, flight)
+                self.abandoned += 1
+                task.cancel()
+
+    def _finish(self, key: str, flight: list):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.flights),
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+# ============================================================
+# Generation concurrency
+# ============================================================
+
+MAX_CONCURRENCY = 8              # upstream generations in flight, whole process
+MAX_CONCURRENCY_PER_REQUEST = 4  # upstream generations in flight, one request
+
+generation_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def describe_error(e: BaseException) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"upstream returned {e.response.status_code}"
+    if isinstance(e, httpx.TimeoutException):
+        return "upstream timeout"
+    if isinstance(e, UpstreamUnavailable):
+        return "upstream unavailable"
+    return str(e) or type(e).__name__
+
+
+@asynccontextmanager
+async def generation_slot(request_slots: asyncio.Semaphore, waited: float = 0.0):
+    # per-request + global slot; waited = time already spent in admission
+    started = time.perf_counter()
+    SLOT_WAITING.inc()
+    try:
+        await request_slots.acquire()
+        try:
+            await generation_slots.acquire()
+        except BaseException:
+            request_slots.release()
+            raise
+    finally:
+        SLOT_WAITING.dec()
+
+    PHASE_SECONDS.observe(waited + time.perf_counter() - started, PHASE_QUEUE_WAIT)
+    UPSTREAM_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        UPSTREAM_IN_FLIGHT.dec()
+        generation_slots.release()
+        request_slots.release()
+
+
+CLIENT_POLL_INTERVAL = 1.0  # seconds between checks that the caller is still there
+
+
+def request_deadline(request: Request) -> float | None:
+    # X-Request-Timeout: seconds the caller will wait, e.g. LiteLLM's timeout
+    try:
+        return time.monotonic() + float(request.headers["x-request-timeout"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def client_gone(request: Request, deadline: float | None) -> str:
+    # returns why the caller no longer wants the result
+    while True:
+        wait = CLIENT_POLL_INTERVAL
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                return "deadline"
+        await asyncio.sleep(wait)
+        if await request.is_disconnected():
+            return "disconnected"
+
+
+async def follow_client(request: Request, work: Awaitable[Response]) -> Response:
+    # work is cancelled (upstream requests, queued images) once the caller is gone
+    task = asyncio.ensure_future(work)
+    watch = asyncio.ensure_future(client_gone(request, request_deadline(request)))
+    try:
+        await asyncio.wait((task, watch), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watch.cancel()
+        raise
+    if task.done():
+        watch.cancel()
+        return task.result()
+
+    reason = watch.result()
+    task.cancel()
+    try:
+        # finished in the meantime after all
+        return await task
+    except asyncio.CancelledError:
+        pass
+    CANCELLED.inc(1, (reason,))
+    if reason == "deadline":
+        return JSONResponse(status_code=504, content={"error": "request deadline exceeded"})
+    return Response(status_code=499)  # nobody is listening, for the logs and metrics
+
+
+# ============================================================
+# Jobs (async=true, polled or followed over SSE)
+# ============================================================
+
+JOBS_TTL = 3600  # seconds a finished job and its result are kept
+JOBS_MAX = 200  # jobs tracked at once, running or finished
+JOBS_MAX_BYTES = 512 * 1024 * 1024  # finished results kept in memory, oldest dropped first
+
+
+class Job:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "queued"  # queued -> running -> succeeded | failed
+        self.created = int(time.time())
+        self.updated = self.created
+        self.status_code: int | None = None
+        self.body: bytes | None = None  # the response the synchronous call would have sent
+        self.task: asyncio.Task | None = None
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def set_status(self, status: str):
+        self.status = status
+        self.updated = int(time.time())
+        # wake every watcher, later ones wait on a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def running(self):
+        if self.status == "queued":
+            self.set_status("running")
+
+    def render(self) -> bytes:
+        head = {
+            "id": self.id,
+            "object": "image.job",
+            "status": self.status,
+            "created": self.created,
+            "updated": self.updated,
+        }
+        if self.status_code is not None:
+            head["status_code"] = self.status_code
+        text = json.dumps(head).encode("utf-8")
+        if self.body is None:
+            return text
+        # the result is already JSON, splice it in instead of re-encoding megabytes
+        return text[:-1] + b', "result": ' + self.body + b"}"
+
+
+async def response_body(response: Response) -> bytes:
+    if isinstance(response, StreamingResponse):
+        chunks = []
+        async for chunk in response.body_iterator:
+            chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+        return b"".join(chunks)
+    return bytes(response.body)
+
+
+class JobStore:
+    def __init__(self, ttl: int, max_jobs: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()  # oldest first
+        self.result_bytes = 0
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def submit(self, run: Callable[[Job], Awaitable[Response]]) -> Job | None:
+        self.sweep()
+        if len(self.jobs) >= self.max_jobs and not self._evict_finished():
+            self.rejected += 1
+            return None
+        job = Job("job_" + secrets.token_hex(16))
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        self.sweep()
+        return self.jobs.get(job_id)
+
+    async def _run(self, job: Job, run: Callable[[Job], Awaitable[Response]]):
+        try:
+            response = await run(job)
+            body = await response_body(response)
+            self._finish(job, response.status_code, body)
+        except asyncio.CancelledError:
+            self._finish(job, 503, json.dumps({"error": "job cancelled"}).encode("utf-8"))
+            raise
+        except Exception as e:
+            self._finish(job, 500, json.dumps({"error": describe_error(e)}).encode("utf-8"))
+
+    def _finish(self, job: Job, status_code: int, body: bytes):
+        job.status_code = status_code
+        job.body = body
+        job.task = None
+        self.result_bytes += len(body)
+        if status_code < 400:
+            self.succeeded += 1
+            job.set_status("succeeded")
+        else:
+            self.failed += 1
+            job.set_status("failed")
+        while self.result_bytes > self.max_bytes and self._evict_finished(keep=job):
+            pass
+
+    def _forget(self, job: Job):
+        del self.jobs[job.id]
+        self.result_bytes -= len(job.body or b"")
+
+    def _evict_finished(self, keep: Job | None = None) -> bool:
+        for job in self.jobs.values():
+            if job.done and job is not keep:
+                self._forget(job)
+                self.evicted += 1
+                return True
+        return False
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for job in [j for j in self.jobs.values() if j.done and j.updated < cutoff]:
+            self._forget(job)
+
+    async def janitor(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            self.sweep()
+
+    def cancel_all(self):
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+
+    def stats(self) -> dict:
+        active = sum(1 for job in self.jobs.values() if not job.done)
+        return {
+            "jobs": len(self.jobs),
+            "active": active,
+            "result_bytes": self.result_bytes,
+            "max_jobs": self.max_jobs,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
+
+
+# ============================================================
+# Rate limit (adaptive, learned from upstream answers)
+# ============================================================
+
+RPM_LIMIT = 12  # where the adaptive rate starts
+QUEUE_MAX_WAIT = 60.0  # seconds a request may wait for its turn before 503
+
+ADAPTIVE_ENABLED = True  # without it the rate stays at RPM_LIMIT
+ADAPTIVE_INCREASE = 1.0  # RPM gained per minute spent at the limit without refusals
+ADAPTIVE_DECREASE = 0.5  # RPM multiplier when upstream answers 429 or 503
+ADAPTIVE_DECREASE_INTERVAL = 10.0  # one decrease per burst of refusals
+ADAPTIVE_MIN_RPM = 1.0
+ADAPTIVE_MAX_FACTOR = 4.0  # never above RPM_LIMIT times this
+ADAPTIVE_MAX_PAUSE = 86400.0  # longest Retry-After honoured, seconds
+ADAPTIVE_STATE_PATH = "/root/ai/polligenapi4290-free/adaptive.json"
+ADAPTIVE_SAVE_INTERVAL = 30.0
+
+
+def retry_after_seconds(response: httpx.Response) -> float | None:
+    # Retry-After as seconds or as an HTTP date
+    value = response.headers.get("retry-after", "").strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limit_pause(response: httpx.Response) -> float | None:
+    # seconds upstream wants us to stay away: Retry-After on a refusal,
+    # or RateLimit-Remaining: 0 with its reset (seconds or epoch)
+    if response.status_code in (429, 503):
+        seconds = retry_after_seconds(response)
+        if seconds is not None:
+            return min(seconds, ADAPTIVE_MAX_PAUSE)
+    headers = response.headers
+    remaining = headers.get("ratelimit-remaining", headers.get("x-ratelimit-remaining"))
+    reset = headers.get("ratelimit-reset", headers.get("x-ratelimit-reset"))
+    try:
+        if remaining is None or reset is None or float(remaining) > 0:
+            return None
+        seconds = float(reset)
+    except ValueError:
+        return None
+    if seconds > 10**9:
+        seconds -= time.time()
+    return min(max(0.0, seconds), ADAPTIVE_MAX_PAUSE)
+
+
+class RateLimiter:
+    # RPM token bucket in front of the free endpoint, requests take their
+    # turn in arrival order (asyncio.Lock is FIFO)
+    def __init__(self, rpm: float, max_wait: float):
+        self.capacity = float(rpm)
+        self.rate = rpm / 60.0  # tokens per second
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.max_wait = max_wait
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+
+    def _advance(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, units: int) -> float:
+        # a full bucket admits more than it holds and goes into debt
+        self._advance()
+        return max(0.0, (min(units, self.capacity) - self.tokens) / self.rate)
+
+    def set_rpm(self, rpm: float):
+        self._advance()
+        self.capacity = float(rpm)
+        self.rate = rpm / 60.0
+        self.tokens = min(self.tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        # upstream asked for a break: empty the bucket that far into debt
+        self._advance()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def saturated(self) -> bool:
+        # requests are waiting for tokens, more rate would be used
+        self._advance()
+        return self.waiting > 0 or self.tokens < 1.0
+
+    async def admit(self, units: int) -> float | None:
+        # None once admitted, otherwise the seconds a retry should wait
+        deadline = time.monotonic() + self.max_wait
+        self.waiting += 1
+        try:
+            try:
+                await asyncio.wait_for(self.lock.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return self.wait_time(units)
+            try:
+                delayed = False
+                while True:
+                    wait = self.wait_time(units)
+                    if wait == 0.0:
+                        break
+                    if time.monotonic() + wait > deadline:
+                        self.rejected += 1
+                        return wait
+                    delayed = True
+                    await asyncio.sleep(wait)
+                self.tokens -= units
+                self.admitted += 1
+                self.delayed += delayed
+                return None
+            finally:
+                self.lock.release()
+        finally:
+            self.waiting -= 1
+
+    def stats(self) -> dict:
+        self._advance()
+        return {
+            "rpm_limit": round(self.capacity, 2),
+            "tokens": round(self.tokens, 3),
+            "waiting": self.waiting,
+            "max_wait": self.max_wait,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "rejected": self.rejected,
+        }
+
+
+class AdaptiveRate:
+    # AIMD on a limiter's RPM: up while upstream accepts requests at the
+    # limit, cut when it answers 429/503, paused for as long as it asks
+    def __init__(self, limiter: RateLimiter, rpm: float, saturated: Callable[[], bool]):
+        self.limiter = limiter
+        self.saturated = saturated
+        self.seed = float(rpm)
+        self.rpm = float(rpm)
+        self.decreased_at = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.pauses = 0
+        self.dirty = False  # learned rate not saved yet
+
+    def set_rpm(self, rpm: float):
+        self.rpm = min(self.seed * ADAPTIVE_MAX_FACTOR, max(ADAPTIVE_MIN_RPM, rpm))
+        self.limiter.set_rpm(self.rpm)
+        self.dirty = True
+
+    def observe(self, response: httpx.Response):
+        pause = rate_limit_pause(response)
+        if response.status_code in (429, 503):
+            now = time.monotonic()
+            if now - self.decreased_at >= ADAPTIVE_DECREASE_INTERVAL:
+                self.decreased_at = now
+                self.decreases += 1
+                self.set_rpm(self.rpm * ADAPTIVE_DECREASE)
+        elif not response.is_error and self.saturated():
+            # one success per token, so about ADAPTIVE_INCREASE per minute at the limit
+            self.increases += 1
+            self.set_rpm(self.rpm + ADAPTIVE_INCREASE / self.rpm)
+        if pause:
+            self.pauses += 1
+            self.limiter.pause(pause)
+
+    def stats(self) -> dict:
+        return {
+            "rpm": round(self.rpm, 2),
+            "seed_rpm": self.seed,
+            "max_rpm": self.seed * ADAPTIVE_MAX_FACTOR,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "pauses": self.pauses,
+        }
+
+
+def load_rate(path: str, rate: AdaptiveRate):
+    # the rate learned in the last run
+    try:
+        saved = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"[poligen-free] Failed to read adaptive rate: {e}")
+        return
+    if saved.get("seed_rpm") == rate.seed:
+        rate.set_rpm(float(saved["rpm"]))
+        rate.dirty = False
+
+
+def save_rate(path: str, rate: AdaptiveRate):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(f"{path}.tmp")
+    tmp.write_text(
+        json.dumps({"rpm": rate.rpm, "seed_rpm": rate.seed, "updated": int(time.time())}),
+        encoding="utf-8",
+    )
+    os.replace(tmp, path)
+    rate.dirty = False
+
+
+async def keep_rate(path: str, rate: AdaptiveRate):
+    # the learned rate is saved, so a restart does not start over
+    while True:
+        await asyncio.sleep(ADAPTIVE_SAVE_INTERVAL)
+        if rate.dirty:
+            try:
+                await asyncio.to_thread(save_rate, path, rate)
+            except OSError as e:
+                print(f"[poligen-free] Failed to save adaptive rate: {e}")
+
 
 # ============================================================
 # Pollinations client (free)
 # ============================================================
 
+POOL_MAX_CONNECTIONS = MAX_CONCURRENCY * 2  # streamed bodies outlive their generation slot
+POOL_MAX_KEEPALIVE = MAX_CONCURRENCY
+POOL_KEEPALIVE_EXPIRY = 120.0  # seconds an idle connection is kept open
+POOL_HTTP2 = True  # multiplex over one connection, needs the h2 package
+POOL_PREWARM = 2  # connections opened at startup, 0 = off
+POOL_PREWARM_TIMEOUT = 10.0
+
+HEDGE_ENABLED = False  # opt-in, every hedge is a second upstream generation
+HEDGE_PERCENTILE = 0.95  # hedge requests slower than this share of recent ones
+HEDGE_MIN_SAMPLES = 20  # latencies needed before the percentile is trusted
+HEDGE_MIN_DELAY = 5.0  # never hedge earlier than this, seconds
+HEDGE_WINDOW = 200  # recent latencies the percentile is taken from
+HEDGE_BUDGET = 0.1  # hedges per minute, as a share of upstream requests in that minute
+
+BREAKER_FAILURES = 5  # consecutive upstream failures that open the circuit
+BREAKER_OPEN_SECONDS = 30.0  # first wait before a probe request is let through
+BREAKER_MAX_OPEN_SECONDS = 300.0  # the wait doubles after each failed probe, up to this
+TIMEOUT_MAX = 600.0  # generation timeout before enough latencies are known
+TIMEOUT_MIN = 60.0
+TIMEOUT_PERCENTILE = 0.99  # per model and size
+TIMEOUT_FACTOR = 3.0  # timeout = percentile latency * factor, within MIN..MAX
+TIMEOUT_MIN_SAMPLES = 20
+TIMEOUT_WINDOW = 200  # recent latencies kept per model and size
+TIMEOUT_MAX_KEYS = 50  # model/size combinations tracked, least recent dropped
+
+
+class UpstreamUnavailable(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("upstream unavailable (circuit open)")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int, open_seconds: float, max_open_seconds: float):
+        self.threshold = failures
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = "closed"  # closed -> open -> half_open -> closed | open
+        self.failures = 0  # consecutive
+        self.opened_at = 0.0
+        self.open_for = open_seconds
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    def available(self) -> bool:
+        if self.state == "open" and time.monotonic() >= self.opened_at + self.open_for:
+            self.state = "half_open"
+        return self.state == "closed" or (self.state == "half_open" and not self.probing)
+
+    def retry_after(self) -> int:
+        if self.state != "open":
+            return 1
+        return max(1, int(self.opened_at + self.open_for - time.monotonic() + 0.999))
+
+    def acquire(self) -> bool:
+        # True = this request is the half-open probe
+        if not self.available():
+            self.rejected += 1
+            raise UpstreamUnavailable(self.retry_after())
+        if self.state == "half_open":
+            self.probing = True
+            return True
+        return False
+
+    def record(self, ok: bool, probe: bool):
+        if probe:
+            self.probing = False
+        if ok:
+            self.state = "closed"
+            self.failures = 0
+            self.open_for = self.open_seconds
+            return
+        self.failures += 1
+        if probe or self.state == "half_open":
+            self._trip(min(self.max_open_seconds, self.open_for * 2))
+        elif self.state == "closed" and self.failures >= self.threshold:
+            self._trip(self.open_seconds)
+
+    def release(self, probe: bool):
+        # cancelled before an answer, no verdict
+        if probe:
+            self.probing = False
+
+    def _trip(self, open_for: float):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.open_for = open_for
+        self.trips += 1
+
+    def stats(self) -> dict:
+        self.available()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_after": self.retry_after() if self.state == "open" else None,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class LatencyTracker:
+    # recent time-to-first-byte per (model, size), the image is generated before it
+    def __init__(self):
+        self.samples: "OrderedDict[tuple, deque]" = OrderedDict()
+
+    def observe(self, key: tuple, seconds: float):
+        window = self.samples.get(key)
+        if window is None:
+            window = self.samples[key] = deque(maxlen=TIMEOUT_WINDOW)
+            if len(self.samples) > TIMEOUT_MAX_KEYS:
+                self.samples.popitem(last=False)
+        else:
+            self.samples.move_to_end(key)
+        window.append(seconds)
+
+    def percentile(self, key: tuple, q: float) -> float | None:
+        window = self.samples.get(key)
+        if window is None or len(window) < TIMEOUT_MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        return ordered[int(q * (len(ordered) - 1))]
+
+    def timeout(self, key: tuple) -> float:
+        latency = self.percentile(key, TIMEOUT_PERCENTILE)
+        if latency is None:
+            return TIMEOUT_MAX
+        return min(TIMEOUT_MAX, max(TIMEOUT_MIN, latency * TIMEOUT_FACTOR))
+
+    def stats(self) -> dict:
+        stats = {}
+        for key, window in self.samples.items():
+            p50 = self.percentile(key, 0.5)
+            p99 = self.percentile(key, TIMEOUT_PERCENTILE)
+            stats[" ".join(key)] = {
+                "samples": len(window),
+                "p50": round(p50, 3) if p50 is not None else None,
+                "p99": round(p99, 3) if p99 is not None else None,
+                "timeout": round(self.timeout(key), 1),
+            }
+        return stats
+
+
+class HedgePolicy:
+    def __init__(self, percentile: float, budget: float):
+        self.percentile = percentile
+        self.budget = budget
+        self.samples: deque = deque(maxlen=HEDGE_WINDOW)
+        self.requests: deque = deque()  # start times, last minute
+        self.hedged: deque = deque()  # hedge times, last minute
+        self.hedges = 0
+        self.wins = 0
+        self.denied = 0
+
+    def delay(self) -> float | None:
+        # None = not enough history yet, wait without hedging
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return max(HEDGE_MIN_DELAY, ordered[int(self.percentile * (len(ordered) - 1))])
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def started(self):
+        now = time.time()
+        self.requests.append(now)
+        self._trim(now)
+
+    def _trim(self, now: float):
+        for window in (self.requests, self.hedged):
+            while window and window[0] < now - 60:
+                window.popleft()
+
+    def allow(self) -> bool:
+        now = time.time()
+        self._trim(now)
+        if len(self.hedged) >= self.budget * len(self.requests):
+            self.denied += 1
+            return False
+        self.hedged.append(now)
+        self.hedges += 1
+        return True
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {
+            "percentile": self.percentile,
+            "delay": round(delay, 3) if delay is not None else None,
+            "samples": len(self.samples),
+            "budget": self.budget,
+            "hedges": self.hedges,
+            "wins": self.wins,
+            "denied": self.denied,
+        }
+
 class PollinationsClientFree:
     BASE_URL = "https://image.pollinations.ai/prompt/"
 
@@ -52,10 +1437,28 @@ class PollinationsClientFree:
         "1440x2560": "portrait_large",
     }
 
-    def __init__(self):
+    def __init__(self, cache: ImageCache | None = None):
+        self.cache = cache
+        self.flights = SingleFlight()
+        self.hedge = HedgePolicy(HEDGE_PERCENTILE, HEDGE_BUDGET) if HEDGE_ENABLED else None
+        self.on_response: Callable[[httpx.Response], None] | None = None  # sees every upstream answer
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_OPEN_SECONDS, BREAKER_MAX_OPEN_SECONDS)
+        self.latencies = LatencyTracker()
+        self.http2 = POOL_HTTP2 and h2 is not None
+        self.requests = 0
+        self.connects = 0
+        self.transport = httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            ),
+        )
         self.client = httpx.AsyncClient(
+            transport=self.transport,
             follow_redirects=True,
-            timeout=httpx.Timeout(600.0, connect=10.0),
+            timeout=httpx.Timeout(TIMEOUT_MAX, connect=10.0),
             headers={
                 "User-Agent": "poligen-free/1.0",
                 "Accept": "image/*",
@@ -66,23 +1469,98 @@ class PollinationsClientFree:
         fmt = self.SIZE_MAP.get(size, "landscape")
         return self.FORMATS[fmt]
 
-    async def generate_image_b64(
+    def cache_key(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int,
+    ) -> str:
+        width, height = self.map_size(size)
+        return ImageCache.make_key(prompt, width, height, model, enhance, seed)
+
+    async def cached_image(
         self,
         prompt: str,
         size: str = "1920x1080",
         model: str = "flux",
         enhance: bool = True,
         seed: int | None = None,
-    ) -> str:
+    ) -> bytes | None:
+        # only explicitly seeded requests are deterministic enough to cache
+        if self.cache is None or seed is None:
+            return None
+        return await self.cache.get(self.cache_key(prompt, size, model, enhance, seed))
+
+    def is_generating(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> bool:
+        if seed is None:
+            return False
+        return self.cache_key(prompt, size, model, enhance, seed) in self.flights
+
+    async def generate_image(
+        self,
+        prompt: str,
+        size: str = "1920x1080",
+        model: str = "flux",
+        enhance: bool = True,
+        seed: int | None = None,
+    ) -> bytes:
+        if seed is None:
+            data = await self.fetch_image(prompt, size, model, enhance, None)
+        else:
+            key = self.cache_key(prompt, size, model, enhance, seed)
+            data = await self.flights.do(
+                key,
+                lambda: self._generate_seeded(key, prompt, size, model, enhance, seed),
+            )
+        return data
+
+    async def generate_image_b64(self, *args, **kwargs) -> str:
+        data = await self.generate_image(*args, **kwargs)
+        return base64.b64encode(data).decode("utf-8")
+
+    async def _generate_seeded(
+        self,
+        key: str,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int,
+    ) -> bytes:
+        # a flight that just finished may have filled the cache meanwhile
+        if self.cache is not None:
+            data = await self.cache.get(key, record=False)
+            if data is not None:
+                return data
+
+        data = await self.fetch_image(prompt, size, model, enhance, seed)
+        if self.cache is not None:
+            await self.cache.put(key, data)
+        return data
+
+    def _image_request(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> httpx.Request:
         width, height = self.map_size(size)
 
+        deterministic = seed is not None
         if seed is None:
             seed = random.randint(0, 999999)
 
-        nonce = random.randint(100000, 999999)
-        safe_prompt = quote(f"{prompt}::{nonce}", safe="")
-        url = f"{self.BASE_URL}{safe_prompt}"
-
         params = {
             "width": width,
             "height": height,
@@ -90,13 +1568,163 @@ class PollinationsClientFree:
             "nologo": "true",
             "enhance": str(enhance).lower(),
             "seed": seed,
-            "t": int(time.time()),
         }
 
-        resp = await self.client.get(url, params=params)
-        resp.raise_for_status()
+        if deterministic:
+            # same seed + params must give the same image, no cache busting
+            safe_prompt = quote(prompt, safe="")
+        else:
+            nonce = random.randint(100000, 999999)
+            safe_prompt = quote(f"{prompt}::{nonce}", safe="")
+            params["t"] = int(time.time())
+
+        url = f"{self.BASE_URL}{safe_prompt}"
+
+        return self.client.build_request("GET", url, params=params)
+
+    async def open_image(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> httpx.Response:
+        # status checked, body left unread for the caller to stream
+        request = self._image_request(prompt, size, model, enhance, seed)
+        if self.hedge is None:
+            return await self._send(request)
+        return await self._send_hedged(request)
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        probe = self.breaker.acquire()
+        params = request.url.params
+        key = (params.get("model", ""), f"{params.get('width')}x{params.get('height')}")
+        # generation happens before the first byte, so the read timeout bounds it
+        request.extensions["timeout"] = {**request.extensions.get("timeout", {}), "read": self.latencies.timeout(key)}
+        connect_started = 0.0
 
-        return base64.b64encode(resp.content).decode("utf-8")
+        async def trace(event: str, info: dict):
+            nonlocal connect_started
+            if event == "connection.connect_tcp.started":
+                connect_started = time.perf_counter()
+                self.connects += 1
+            elif connect_started and (
+                event == "connection.start_tls.complete"
+                or (event == "connection.connect_tcp.complete" and request.url.scheme == "http")
+            ):
+                PHASE_SECONDS.observe(time.perf_counter() - connect_started, PHASE_CONNECT)
+
+        request.extensions["trace"] = trace
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            resp = await self.client.send(request, stream=True)
+        except httpx.TransportError:
+            self.breaker.record(False, probe)
+            raise
+        except BaseException:
+            self.breaker.release(probe)
+            raise
+        elapsed = time.perf_counter() - started
+        PHASE_SECONDS.observe(elapsed, PHASE_TTFB)
+        if self.on_response is not None:
+            self.on_response(resp)
+        if resp.is_error:
+            # 4xx and 429 mean the upstream is up
+            self.breaker.record(resp.status_code < 500, probe)
+            await resp.aclose()
+            resp.raise_for_status()
+        self.breaker.record(True, probe)
+        self.latencies.observe(key, elapsed)
+        return resp
+
+    async def _send_hedged(self, request: httpx.Request) -> httpx.Response:
+        # past the learned percentile, race a duplicate and keep the first answer
+        policy = self.hedge
+        policy.started()
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(self._send(request))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=policy.delay())
+            if not done and policy.allow():
+                # same URL, so the same seed and model
+                duplicate = httpx.Request(
+                    request.method, request.url, headers=request.headers, extensions=dict(request.extensions)
+                )
+                tasks.append(asyncio.create_task(self._send(duplicate)))
+
+            error = None
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = winner or task
+                    else:
+                        error = error or task.exception()
+            if winner is None:
+                raise error
+
+            policy.observe(time.perf_counter() - started)
+            if winner is not tasks[0]:
+                policy.wins += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    await task.result().aclose()
+
+    async def fetch_image(
+        self,
+        prompt: str,
+        size: str,
+        model: str,
+        enhance: bool,
+        seed: int | None,
+    ) -> bytes:
+        resp = await self.open_image(prompt, size, model, enhance, seed)
+        return await read_image(resp)
+
+    async def prewarm(self, connections: int = POOL_PREWARM) -> int:
+        # pay DNS, TCP and TLS before the first image request does
+        parts = urlsplit(self.BASE_URL)
+        origin = f"{parts.scheme}://{parts.netloc}/"
+
+        async def touch():
+            await self.client.head(origin, timeout=POOL_PREWARM_TIMEOUT)
+
+        # HTTP/2 is negotiated over TLS only, one connection then carries every request
+        count = 1 if self.http2 and parts.scheme == "https" else connections
+        await asyncio.gather(*(touch() for _ in range(count)), return_exceptions=True)
+        return len(self.pool_connections())
+
+    def pool_connections(self) -> list:
+        # httpx keeps the httpcore pool private, read it defensively
+        pool = getattr(self.transport, "_pool", None)
+        return list(getattr(pool, "connections", ()))
+
+    def pool_stats(self) -> dict:
+        connections = self.pool_connections()
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            "http2": self.http2,
+            "max_connections": POOL_MAX_CONNECTIONS,
+            "max_keepalive": POOL_MAX_KEEPALIVE,
+            "keepalive_expiry": POOL_KEEPALIVE_EXPIRY,
+            "open": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle,
+            "http2_connections": sum(1 for c in connections if "HTTP/2" in c.info()),
+            "requests": self.requests,
+            "connects": self.connects,
+            "reuse_ratio": round(1.0 - min(self.connects, self.requests) / self.requests, 4) if self.requests else None,
+        }
 
     async def close(self):
         await self.client.aclose()
@@ -106,12 +1734,51 @@ class PollinationsClientFree:
 # FastAPI app
 # ============================================================
 
-client = PollinationsClientFree()
+cache = ImageCache(CACHE_DIR, CACHE_MAX_BYTES) if CACHE_ENABLED else None
+files = ImageStore(FILES_DIR, FILES_TTL, FILES_SECRET_PATH)
+jobs = JobStore(JOBS_TTL, JOBS_MAX, JOBS_MAX_BYTES)
+resizer = Resizer(RESIZE_WORKERS)
+client = PollinationsClientFree(cache=cache)
+limiter = RateLimiter(RPM_LIMIT, QUEUE_MAX_WAIT)
+adaptive = AdaptiveRate(limiter, RPM_LIMIT, limiter.saturated)
+if ADAPTIVE_ENABLED:
+    client.on_response = adaptive.observe
+
+def use_upstream(origin: str):
+    # point the client at another host (a mirror, the bench mock), keeping its path
+    client.BASE_URL = origin.rstrip("/") + urlsplit(client.BASE_URL).path
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("[poligen-free] Free Pollinations proxy started")
+    await resizer.open()
+    if ADAPTIVE_ENABLED:
+        load_rate(ADAPTIVE_STATE_PATH, adaptive)
+        print(f"[poligen-free] Adaptive rate {adaptive.rpm:.1f} RPM (configured {RPM_LIMIT})")
+    if POOL_HTTP2 and h2 is None:
+        print('[poligen-free] HTTP/2 unavailable (pip install "httpx[http2]"), using HTTP/1.1')
+    if POOL_PREWARM:
+        print(f"[poligen-free] {await client.prewarm()} upstream connections pre-warmed")
+    if cache is not None:
+        await asyncio.to_thread(cache.load)
+        print(f"[poligen-free] Image cache: {len(cache.entries)} entries, {cache.total_bytes} bytes")
+    await asyncio.to_thread(files.open)
+    janitor = asyncio.create_task(files.janitor())
+    jobs_janitor = asyncio.create_task(jobs.janitor())
+    lag_watch = asyncio.create_task(watch_loop_lag())
+    rate_saver = asyncio.create_task(keep_rate(ADAPTIVE_STATE_PATH, adaptive))
     yield
+    rate_saver.cancel()
+    if adaptive.dirty:
+        try:
+            save_rate(ADAPTIVE_STATE_PATH, adaptive)
+        except OSError as e:
+            print(f"[poligen-free] Failed to save adaptive rate: {e}")
+    lag_watch.cancel()
+    jobs_janitor.cancel()
+    jobs.cancel_all()
+    janitor.cancel()
+    resizer.close()
     await client.close()
 
 app = FastAPI(
@@ -126,36 +1793,291 @@ app = FastAPI(
 @app.post("/v1/images/generations")
 async def image_generation(request: Request):
     body = await request.json()
+    if request.query_params.get("async", "").lower() in ("1", "true", "yes"):
+        job = jobs.submit(lambda job: run_generation(request, body, job.running))
+        if job is None:
+            return JSONResponse(status_code=503, content={"error": "too many jobs, try again later"})
+        return Response(
+            job.render(),
+            status_code=202,
+            media_type="application/json",
+            headers={"Location": f"/v1/images/jobs/{job.id}"},
+        )
+    return await run_generation(request, body, follow=True)
+
+
+async def run_generation(
+    request: Request,
+    body: dict,
+    on_running: Callable[[], None] | None = None,
+    follow: bool = False,
+) -> Response:
+    model = model_label(body.get("model", "flux"))
 
+    IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        work = generate_images(request, body, on_running)
+        # a synchronous caller may leave; jobs run on without one
+        response = await (follow_client(request, work) if follow else work)
+        status = response.status_code
+        return response
+    finally:
+        IN_FLIGHT.dec()
+        REQUESTS.inc(1, (str(status), model))
+        REQUEST_SECONDS.observe(time.perf_counter() - started, (model,))
+
+
+async def generate_images(
+    request: Request,
+    body: dict,
+    on_running: Callable[[], None] | None = None,
+) -> Response:
     prompt = body.get("prompt")
     if not prompt:
         return JSONResponse(status_code=400, content={"error": "prompt required"})
 
-    size = body.get("size", "1920x1080")
+    response_format = body.get("response_format") or "b64_json"
+    if response_format not in ("b64_json", "url"):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "response_format must be 'b64_json' or 'url'"},
+        )
+
+    output_format = body.get("output_format")
+    if output_format is not None and not resizer.available:
+        return JSONResponse(status_code=400, content={"error": "output_format is not available on this server"})
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "output_format must be 'png', 'jpeg' or 'webp'"},
+        )
+    quality = body.get("output_compression")
+    quality = OUTPUT_QUALITY if quality is None else min(100, max(1, int(quality)))
+
+    # exact sizes are cut from the nearest larger native format
+    size, resize = resizer.plan(body.get("size", "1920x1080"), client.FORMATS)
     model = body.get("model", "flux")
-    n = int(body.get("n", 1))
+    n = max(1, int(body.get("n", 1)))
+    enhance = bool(body.get("enhance", True))
+    seed = body.get("seed")
+
+    # explicit seed -> deterministic images, one seed per image
+    seeds = [None] * n if seed is None else [int(seed) + i for i in range(n)]
 
+    # --- cache ---
     images = []
-    for _ in range(max(1, n)):
-        img_b64 = await client.generate_image_b64(
-            prompt=prompt,
-            size=size,
-            model=model,
+    for s in seeds:
+        images.append(
+            await client.cached_image(
+                prompt=prompt,
+                size=size,
+                model=model,
+                enhance=enhance,
+                seed=s,
+            )
         )
-        images.append({"b64_json": img_b64})
 
-    return JSONResponse(
-        content={
-            "created": int(time.time()),
-            "data": images,
-        }
+    # --- generation (concurrent, results keep request order) ---
+    missing = [i for i, img in enumerate(images) if img is None]
+    request_slots = asyncio.Semaphore(MAX_CONCURRENCY_PER_REQUEST)
+    if missing and not client.breaker.available():
+        # failing fast while the upstream is down
+        return JSONResponse(
+            status_code=503,
+            content={"error": "upstream unavailable"},
+            headers={"Retry-After": str(client.breaker.retry_after())},
+        )
+    if missing:
+        wait = await limiter.admit(len(missing))
+        if wait is not None:
+            return JSONResponse(
+                status_code=503,
+                content={"error": "Rate limit wait exceeded"},
+                headers={"Retry-After": str(max(1, int(wait + 0.999)))},
+            )
+    if on_running is not None:
+        on_running()
+
+    opened = []
+
+    async def generate(i: int) -> ImageSource:
+        async with generation_slot(request_slots):
+            if STREAM_RESPONSES and seeds[i] is None:
+                # nothing to cache or share, stream the body through
+                img = await client.open_image(prompt, size, model, enhance, None)
+            else:
+                img = await client.generate_image(
+                    prompt=prompt,
+                    size=size,
+                    model=model,
+                    enhance=enhance,
+                    seed=seeds[i],
+                )
+            opened.append(img)
+            return img
+
+    try:
+        results = await asyncio.gather(
+            *(generate(i) for i in missing),
+            return_exceptions=True,
+        )
+    except asyncio.CancelledError:
+        # the caller left, streams already opened are closed
+        await close_images(opened)
+        raise
+
+    errors = []
+    throttled = []  # Retry-After of images refused with 429
+    for i, result in zip(missing, results):
+        if isinstance(result, BaseException):
+            print(f"[poligen-free] Image {i} failed: {describe_error(result)}")
+            errors.append({"index": i, "error": describe_error(result)})
+            if isinstance(result, httpx.HTTPStatusError) and result.response.status_code == 429:
+                throttled.append(retry_after_seconds(result.response) or 60.0)
+        else:
+            images[i] = result
+
+    ready = [img for img in images if img is not None]
+    if not ready:
+        if errors and len(throttled) == len(errors):
+            # upstream is rate limiting us, say so and when to come back
+            return JSONResponse(
+                status_code=503,
+                content={"error": "upstream rate limited", "errors": errors},
+                headers={"Retry-After": str(max(1, int(max(throttled) + 0.999)))},
+            )
+        return JSONResponse(
+            status_code=502,
+            content={"error": "Image generation failed", "errors": errors}
+        )
+
+    if resize is not None or output_format is not None:
+        ready = await resizer.process(ready, resize, OUTPUT_FORMATS.get(output_format), quality)
+    return await image_response(request, ready, errors, response_format)
+
+
+# ============================================================
+# Image jobs
+# ============================================================
+
+@app.get("/v1/images/jobs/{job_id}")
+async def image_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found or expired"})
+    return Response(job.render(), media_type="application/json")
+
+
+@app.get("/v1/images/jobs/{job_id}/events")
+async def image_job_events(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found or expired"})
+
+    async def events():
+        # one event per state change, the last one ("done") carries the result
+        while not job.done:
+            changed = job.changed
+            yield {"event": job.status, "data": job.render().decode("utf-8")}
+            await changed.wait()
+        yield {"event": "done", "data": job.render().decode("utf-8")}
+
+    return EventSourceResponse(events())
+
+
+# ============================================================
+# Image files
+# ============================================================
+
+@app.get("/v1/images/files/{file_id}")
+async def image_file(file_id: str, expires: int = 0, sig: str = ""):
+    status, path = files.resolve(file_id, expires, sig)
+    if path is None:
+        errors = {403: "invalid signature", 404: "not found", 410: "link expired"}
+        return JSONResponse(status_code=status, content={"error": errors[status]})
+
+    return FileResponse(
+        path,
+        media_type=MEDIA_TYPES.get(path.suffix[1:], "application/octet-stream"),
+        headers={"Cache-Control": f"private, max-age={max(0, expires - int(time.time()))}"},
     )
 
 
+# ============================================================
+# Proxy stats
+# ============================================================
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def update_metrics():
+    if cache is not None:
+        CACHE_HITS.set(cache.hits)
+        CACHE_MISSES.set(cache.misses)
+        CACHE_BYTES.set(cache.total_bytes)
+    COALESCED.set(client.flights.coalesced)
+    BREAKER_STATE.set(BREAKER_STATES[client.breaker.stats()["state"]])
+    pool = client.pool_stats()
+    POOL_CONNECTIONS.set(pool["idle"], ("idle",))
+    POOL_CONNECTIONS.set(pool["active"], ("active",))
+    POOL_CONNECTS.set(pool["connects"])
+    POOL_REQUESTS.set(pool["requests"])
+    ADAPTIVE_RPM.set(adaptive.rpm)
+    RATE_TOKENS.set(limiter.stats()["tokens"])
+
+
+@app.get("/metrics")
+async def metrics():
+    update_metrics()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@app.get("/status")
+async def status():
+    return {
+        "upstreams": [
+            {
+                "base_url": client.BASE_URL,
+                "breaker": client.breaker.stats(),
+                "timeouts": client.latencies.stats(),
+            }
+        ],
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "cache": cache.stats() if cache is not None else None,
+        "files": files.stats(),
+        "jobs": jobs.stats(),
+        "cancelled": {reason: int(count) for (reason,), count in CANCELLED.values.items()},
+        "resize": resizer.stats(),
+        "singleflight": client.flights.stats(),
+        "pool": client.pool_stats(),
+        "hedge": client.hedge.stats() if client.hedge is not None else None,
+        "rate_limit": {**limiter.stats(), "adaptive": adaptive.stats() if ADAPTIVE_ENABLED else None},
+    }
+
+
 # ============================================================
 # Local run
 # ============================================================
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=4290)
+
+    parser = argparse.ArgumentParser(description="Free Pollinations OpenAI-compatible image proxy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4290)
+    parser.add_argument("--upstream", help="send image requests to this origin instead, e.g. http://127.0.0.1:9100")
+    args = parser.parse_args()
+    if args.upstream:
+        use_upstream(args.upstream)
+    uvicorn.run(app, host=args.host, port=args.port)
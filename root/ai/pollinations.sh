@@ -34,12 +34,12 @@ start_polligenapi_4261() {
         /usr/bin/python3 -m venv /root/ai/polligenapi4261/polligen-venv
         source /root/ai/polligenapi4261/polligen-venv/bin/activate
         /root/ai/polligenapi4261/polligen-venv/bin/pip install --upgrade pip
-        /root/ai/polligenapi4261/polligen-venv/bin/pip install fastapi uvicorn httpx sse-starlette pillow
+        /root/ai/polligenapi4261/polligen-venv/bin/pip install fastapi uvicorn "httpx[http2]" sse-starlette pillow
     else
         echo "Activation present virtual environment for Polligen API 4261..."
         source /root/ai/polligenapi4261/polligen-venv/bin/activate
 #        /root/ai/polligenapi4261/polligen-venv/bin/pip install --upgrade pip
-#        /root/ai/polligenapi4261/polligen-venv/bin/pip install fastapi uvicorn httpx sse-starlette pillow
+#        /root/ai/polligenapi4261/polligen-venv/bin/pip install fastapi uvicorn "httpx[http2]" sse-starlette pillow
     fi
 
     echo "Starting Polligen API 4261 Server..."
@@ -63,12 +63,12 @@ start_polligenapi_4290() {
         /usr/bin/python3 -m venv /root/ai/polligenapi4290-free/polligen-venv
         source /root/ai/polligenapi4290-free/polligen-venv/bin/activate
         /root/ai/polligenapi4290-free/polligen-venv/bin/pip install --upgrade pip
-        /root/ai/polligenapi4290-free/polligen-venv/bin/pip install fastapi uvicorn httpx sse-starlette pillow
+        /root/ai/polligenapi4290-free/polligen-venv/bin/pip install fastapi uvicorn "httpx[http2]" sse-starlette pillow
     else
         echo "Activation present virtual environment for Polligen API 4290 Free..."
         source /root/ai/polligenapi4290-free/polligen-venv/bin/activate
 #        /root/ai/polligenapi4290-free/polligen-venv/bin/pip install --upgrade pip
-#        /root/ai/polligenapi4290-free/polligen-venv/bin/pip install fastapi uvicorn httpx sse-starlette pillow
+#        /root/ai/polligenapi4290-free/polligen-venv/bin/pip install fastapi uvicorn "httpx[http2]" sse-starlette pillow
     fi
 
     echo "Starting Polligen API 4290 Free Server..."